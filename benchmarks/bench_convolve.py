@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""
+Benchmark of Preprocessing.convolve against the per pixel reference implementation.
+
+usage: python -m benchmarks.bench_convolve --shape 40 60 1280
+"""
+from src.xrd_data import Preprocessing
+
+from numpy import array,arange,pad,expand_dims,sqrt,exp,fft
+from numpy.random import default_rng
+from scipy.stats import kurtosis
+from scipy import signal
+from time import perf_counter
+
+from argparse import ArgumentParser
+
+def synthetic_cube(shape,seed=0):
+    """
+    Poisson counts of two peaks on a decaying background.
+    """
+    rng = default_rng(seed)
+    c = arange(shape[2])
+
+    background = 50 * exp(-c / (shape[2] / 2))
+    peaks = 400 * exp(-0.5 * ((c - shape[2] * 0.43) / 4)**2) + 200 * exp(-0.5 * ((c - shape[2] * 0.56) / 5)**2)
+
+    return rng.poisson(background + peaks * rng.random(shape[:2] + (1,)))
+
+def convolve_reference(data,off = 48):
+    """
+    Per pixel window selection as it was before the vectorized convolve.
+    """
+    def select(d,off):
+        c1 = []
+        for i in range(d.shape[0]):
+            c2 = []
+            for j in range(d.shape[1]):
+                k = kurtosis(d[i,j])
+                if k < 2:
+                    sigma = sqrt(d[i,j].std())
+                    _w = signal.windows.gaussian(off * 2 - 1 ,sigma)
+                else:
+                    _w = signal.windows.exponential(off * 2 - 1 ,tau = 1)
+                c2 += [_w]
+            c1 += [array(c2)]
+
+        return array(c1)
+
+    win = signal.windows.gaussian(off * 2 - 1 ,3)
+    pad_data = pad(data,((0,0),(0,0),(off,off)),'edge')
+
+    f = fft.rfft(pad_data)
+    w = fft.rfft(win,pad_data.shape[-1])
+    x = fft.irfft(f * w)
+
+    x = x[:,:,off*2-1:-1]
+    x = x / sum(win)
+
+    for i in range(2):
+        d = data - x
+        win = select(d,off)
+
+        w = fft.rfft(win,pad_data.shape[-1])
+        x = fft.irfft(f * w)
+
+        x = x[:,:,off*2-1:-1]
+        sum_win = expand_dims(win.sum(axis=2),2)
+        x = x / sum_win
+
+    return x
+
+def timeit(fce,*args,repeat=3):
+    best = None
+    for _ in range(repeat):
+        t = perf_counter()
+        result = fce(*args)
+        t = perf_counter() - t
+        best = t if best is None else min(best,t)
+
+    return best,result
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--shape',nargs=3,default=[40,60,1280],type=int,help='rows columns channels')
+    parser.add_argument('--repeat',default=3,type=int)
+    parser.add_argument('--no-reference',dest='reference',action='store_false',help='skip the slow reference')
+
+    args = parser.parse_args()
+
+    data = synthetic_cube(tuple(args.shape))
+    pixels = args.shape[0] * args.shape[1]
+
+    t,x = timeit(Preprocessing.convolve,data,repeat=args.repeat)
+    print('convolve:  %.3f s  %.0f pixels/s'%(t,pixels / t))
+
+    if args.reference:
+        t_ref,x_ref = timeit(convolve_reference,data,repeat=args.repeat)
+        print('reference: %.3f s  %.0f pixels/s'%(t_ref,pixels / t_ref))
+        print('speedup:   %.1fx  max deviation: %.3g'%(t_ref / t,abs(x - x_ref).max()))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+"""
+Benchmark of the data.h5 layouts: file size, write time and read throughput.
+
+usage: python -m benchmarks.bench_h5_layout --shape 40 60 1280
+"""
+from src.xrd_data import DataXRD,Preprocessing
+from benchmarks.bench_convolve import synthetic_cube
+
+from numpy.random import default_rng
+from tempfile import TemporaryDirectory
+from time import perf_counter
+import os
+import h5py
+
+from argparse import ArgumentParser
+
+def timeit(fce,repeat=3):
+    best = float('inf')
+    for _ in range(repeat):
+        start = perf_counter()
+        fce()
+        best = min(best,perf_counter() - start)
+
+    return best
+
+def read_bands(name,width=20,n=10):
+    with h5py.File(name,'r') as f:
+        x = f['inverted']
+        for left in range(0,x.shape[2] - width,x.shape[2] // n):
+            x[:,:,left:left + width].sum(axis=2)
+
+def read_pixels(name,pixels):
+    with h5py.File(name,'r') as f:
+        x = f['inverted']
+        for i,j in pixels:
+            x[i,j]
+
+def read_all(name):
+    with h5py.File(name,'r') as f:
+        f['inverted'][:]
+        f['convoluted'][:]
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--shape',nargs=3,default=[40,60,1280],type=int)
+    parser.add_argument('--repeat',default=3,type=int)
+    parser.add_argument('--pixels',default=100,help='number of random pixel spectra read',type=int)
+    args = parser.parse_args()
+
+    data = DataXRD(index=False)
+    data.inverted = synthetic_cube(tuple(args.shape))
+    data.convoluted = Preprocessing.convolve(data.inverted)
+
+    rng = default_rng(0)
+    pixels = list(zip(rng.integers(0,args.shape[0],args.pixels),rng.integers(0,args.shape[1],args.pixels)))
+    mb = (data.inverted.nbytes + data.convoluted.nbytes) / 2**20
+
+    print('%-20s %10s %10s %10s %10s %10s'%('layout','size MB','write s','bands s','pixels s','load MB/s'))
+    with TemporaryDirectory() as path:
+        for layout,compression in [('contiguous',None),('chunked','lzf'),('chunked','gzip')]:
+            name = os.path.join(path,'%s_%s.h5'%(layout,compression))
+
+            write = timeit(lambda: data.save_h5(name,layout,compression),args.repeat)
+            size = os.path.getsize(name) / 2**20
+            bands = timeit(lambda: read_bands(name),args.repeat)
+            pixel = timeit(lambda: read_pixels(name,pixels),args.repeat)
+            load = timeit(lambda: read_all(name),args.repeat)
+
+            print('%-20s %10.2f %10.3f %10.3f %10.3f %10.1f'%('%s %s'%(layout,compression or ''),size,write,bands,pixel,mb / load))
+
+if __name__ == '__main__':
+    main()
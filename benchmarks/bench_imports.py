@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+"""
+Import time of the library and of the command line entry points against a budget.
+
+Every module is imported in a fresh interpreter `--repeat` times. The median
+cumulative import time reported by python -X importtime is compared with the
+budget in ms, and the slowest direct imports of the module are listed. The
+exit status is 1 if a module is over its budget.
+
+usage: python -m benchmarks.bench_imports [--repeat 5] [--budget convert=300] [-o imports.json]
+"""
+from statistics import median
+from time import perf_counter
+import subprocess
+import platform
+import json
+import sys
+import os
+
+from argparse import ArgumentParser
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# ms, most of it is numpy; scipy, matplotlib, h5py and Qt are imported on first use
+BUDGETS = {
+    'src.xrd_data':300,
+    'src.export':300,
+    'src.render':350,
+    'convert':300,
+    'render':350,
+    'main':300,
+}
+
+def run(code):
+    """
+    Wall time in ms and stderr of python -X importtime -c code in a fresh interpreter.
+    """
+    env = dict(os.environ,QT_QPA_PLATFORM='offscreen')
+
+    wall = perf_counter()
+    process = subprocess.run([sys.executable,'-X','importtime','-c',code],cwd=ROOT,env=env,capture_output=True,text=True,check=True)
+
+    return (perf_counter() - wall) * 1000,process.stderr
+
+def import_time(module):
+    """
+    Wall time of the interpreter, cumulative import time of module and its direct imports, in ms.
+    """
+    wall,report = run('import ' + module)
+
+    entries = []
+    for line in report.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+
+        _,cumulative_us,name = line.split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        entries += [(int(cumulative_us),name.strip(),depth)]
+
+    for i,(total,name,depth) in enumerate(entries):
+        if name == module:
+            break
+    else:
+        raise ValueError('%s is not in the import time report'%module)
+
+    # the direct imports of module are printed before it, one level deeper
+    children = []
+    for cumulative,child,child_depth in reversed(entries[:i]):
+        if child_depth <= depth:
+            break
+        if child_depth == depth + 1:
+            children += [(child,cumulative / 1000)]
+
+    return wall,total / 1000,sorted(children,key=lambda child: -child[1])
+
+def measure(module,repeat=5,top=5):
+    runs = [import_time(module) for _ in range(repeat)]
+
+    return {'module':module,
+        'wall_ms':median(wall for wall,_,_ in runs),
+        'import_ms':median(total for _,total,_ in runs),
+        'slowest':runs[-1][2][:top]}
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('modules',nargs='*',default=list(BUDGETS),help='modules to import, the library and the entry points by default')
+    parser.add_argument('--repeat',default=5,type=int)
+    parser.add_argument('--budget',nargs='*',default=[],help='module=ms budgets replacing the defaults')
+    parser.add_argument('-o','--output',default=None,help='JSON output')
+    args = parser.parse_args()
+
+    budgets = dict(BUDGETS)
+    for item in args.budget:
+        module,ms = item.split('=')
+        budgets[module] = float(ms)
+
+    interpreter = median(run('pass')[0] for _ in range(args.repeat))
+    print('%-16s %10s %10s %10s'%('module','wall ms','import ms','budget'))
+    print('%-16s %10.1f'%('(interpreter)',interpreter))
+
+    results = []
+    over = False
+    for module in args.modules:
+        result = measure(module,args.repeat)
+        result['budget_ms'] = budgets.get(module)
+        result['over_budget'] = result['budget_ms'] is not None and result['import_ms'] > result['budget_ms']
+        over |= result['over_budget']
+        results += [result]
+
+        print('%-16s %10.1f %10.1f %10s %s'%(module,result['wall_ms'],result['import_ms'],result['budget_ms'],'OVER' if result['over_budget'] else ''))
+        for name,ms in result['slowest']:
+            print('    %-24s %8.1f'%(name,ms))
+
+    if args.output is not None:
+        with open(args.output,'w') as f:
+            json.dump({'python':platform.python_version(),'interpreter_ms':interpreter,'modules':results},f,indent=1)
+
+    sys.exit(1 if over else 0)
+
+if __name__ == '__main__':
+    main()
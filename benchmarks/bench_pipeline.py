@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+"""
+Benchmark of every pipeline stage on a synthetic scan.
+
+Every stage is measured by src.stages: wall time, CPU time and peak memory,
+to which the throughput is added. The stages are written as JSON, so runs of
+different commits can be compared.
+
+usage: python -m benchmarks.bench_pipeline --shape 20 30 1280 -o bench.json [--compare old.json]
+"""
+from src.xrd_data import DataXRD,Preprocessing,Alignment
+from src.stages import stage
+from benchmarks.synthetic import write_scan
+from src import stages
+
+from numpy.random import default_rng
+from numpy import __version__ as numpy_version
+from tempfile import TemporaryDirectory
+import subprocess
+import platform
+import json
+import sys
+import os
+
+from argparse import ArgumentParser
+
+def throughput(records):
+    """
+    The records of the benchmark stages, with the time per call and the
+    throughput of those processing nbytes.
+    """
+    table = []
+    for record in records:
+        if record['depth'] > 0:
+            continue
+
+        record = dict(record)
+        nbytes = record.pop('nbytes',0)
+        record['calls'] = record.get('calls',1)
+        record['per_call_s'] = record['wall_s'] / record['calls']
+
+        if nbytes:
+            record['mb'] = nbytes / 2**20
+            record['mb_per_s'] = nbytes / 2**20 / record['wall_s'] if record['wall_s'] > 0 else None
+
+        table += [record]
+
+    return table
+
+def commit():
+    try:
+        return subprocess.run(['git','rev-parse','HEAD'],capture_output=True,text=True,check=True).stdout.strip()
+    except (OSError,subprocess.CalledProcessError):
+        return None
+
+def run(path,workers=1,tile=8,bands=20,rois=20,seed=0):
+    """
+    Time the stages on the scan in path, whose XRF set is in path/xrf.
+    """
+    first = len(stages.records)
+    rng = default_rng(seed)
+    files = [os.path.join(path,name) for name in os.listdir(path) if name.startswith('Frame')]
+    source_bytes = sum(os.path.getsize(name) for name in files)
+
+    data = DataXRD(path,calibration='calibration.ini')
+    data.read_params()
+    with stage('read_xrd',nbytes=source_bytes):
+        data.read_xrd(workers)
+
+    with stage('invert',nbytes=data.source.nbytes):
+        data.reshape()
+        data.invert()
+
+    xrf = DataXRD(os.path.join(path,'xrf'),calibration='calibration.ini')
+    if xrf.xrf_names():
+        xrf_bytes = sum(os.path.getsize(name) for name in xrf.xrf_names())
+        with stage('read_xrf',nbytes=xrf_bytes):
+            xrf.read_xrf(workers)
+
+    with stage('convolve',nbytes=data.inverted.nbytes):
+        data.convoluted = data.smooth(data.inverted,workers,tile)
+
+    with stage('snip',nbytes=data.convoluted.nbytes):
+        data.subtract_background(24,workers,tile)
+
+    with stage('shift_z',nbytes=data.inverted.nbytes):
+        Alignment(data.shape[2] * 555 // 1280).align(data.inverted)
+
+    data.shift_y = 2
+    with stage('shift_y',nbytes=data.inverted.nbytes):
+        data.view()
+
+    n_channels = data.shape[2]
+    with stage('band_index',nbytes=data.inverted.nbytes):
+        data.band_index('inverted')
+
+    with stage('crop_spectra',calls=bands):
+        for left in rng.integers(0,n_channels - 40,bands):
+            data.crop_spectra(left,left + rng.integers(1,40))
+
+    with stage('roi_table',nbytes=data.inverted.nbytes + data.convoluted.nbytes):
+        data.roi_table('inverted')
+        data.roi_table('convoluted')
+
+    n_rows,n_columns,_ = data.view_shape
+    with stage('roi_spectra',calls=rois):
+        for _ in range(rois):
+            r0,c0 = rng.integers(0,n_rows),rng.integers(0,n_columns)
+            rows,columns = slice(r0,rng.integers(r0,n_rows) + 1),slice(c0,rng.integers(c0,n_columns) + 1)
+            data.roi_spectra('inverted',rows,columns)
+            Preprocessing.snip(data.roi_spectra('convoluted',rows,columns),24)
+
+    data.shift_y = 0
+    cube_bytes = data.inverted.nbytes + data.convoluted.nbytes
+    for layout in ['contiguous','chunked']:
+        name = os.path.join(path,'%s.h5'%layout)
+
+        with stage('save_h5_' + layout,nbytes=cube_bytes):
+            data.save_h5(name,layout)
+
+        with stage('load_h5_' + layout,nbytes=cube_bytes):
+            DataXRD(path,calibration='calibration.ini').load_h5(name)
+
+        with stage('load_h5_lazy_' + layout):
+            lazy = DataXRD(path,calibration='calibration.ini').load_h5(name,lazy=True)
+            lazy.h5.close()
+
+    return throughput(stages.records[first:])
+
+def compare(old,new):
+    """
+    Print the wall time and peak memory of the stages of new relative to old.
+    """
+    before = {stage['stage']:stage for stage in old['stages']}
+
+    print('%-24s %10s %10s'%('stage','time','memory'))
+    for stage in new['stages']:
+        if stage['stage'] in before:
+            base = before[stage['stage']]
+            time = stage['wall_s'] / base['wall_s'] if base['wall_s'] else float('nan')
+            memory = stage['peak_mb'] / base['peak_mb'] if base['peak_mb'] else float('nan')
+            print('%-24s %9.2fx %9.2fx'%(stage['stage'],time,memory))
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--shape',nargs=3,default=[20,30,1280],type=int,help='map rows, map columns and channels')
+    parser.add_argument('--xrf-channels',default=2048,type=int)
+    parser.add_argument('-w','--workers',default=1,type=int)
+    parser.add_argument('-t','--tile',default=8,type=int)
+    parser.add_argument('--path',default=None,help='keep the synthetic scan in this directory instead of a temporary one')
+    parser.add_argument('-o','--output',default=None,help='JSON output, stdout by default')
+    parser.add_argument('--compare',default=None,help='JSON output of an earlier run to compare with')
+    args = parser.parse_args()
+
+    rows,columns,channels = args.shape
+    stages.configure('json')
+
+    with TemporaryDirectory() as tmp:
+        path = args.path or tmp
+        if not os.path.exists(os.path.join(path,'Scanning_Parameters.txt')):
+            write_scan(path,rows,columns,channels,args.xrf_channels)
+
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull,'w')
+        try:
+            table = run(path,args.workers,args.tile)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+
+    report = {
+        'commit':commit(),
+        'shape':args.shape,
+        'xrf_channels':args.xrf_channels,
+        'workers':args.workers,
+        'tile':args.tile,
+        'python':platform.python_version(),
+        'numpy':numpy_version,
+        'stages':table,
+    }
+
+    if args.output is None:
+        print(json.dumps(report,indent=1))
+    else:
+        with open(args.output,'w') as f:
+            json.dump(report,f,indent=1)
+
+    if args.compare:
+        with open(args.compare,'r') as f:
+            compare(json.load(f),report)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+"""
+Synthetic scans for the benchmarks.
+
+usage: python -m benchmarks.synthetic scan --shape 20 30 1280
+"""
+from numpy import arange,exp,dtype,linspace,meshgrid,stack,savetxt,c_,uint32
+from numpy.random import default_rng
+import os
+
+from argparse import ArgumentParser
+
+# channel,2 theta pairs of the calibration.ini in the repository
+CALIBRATION = [(455,29.36),(716,35.94),(846,39.31),(985,43.16),(1139,47.49),(1179,48.49)]
+
+# reflections of three phases as fractions of the channel axis
+PHASES = [(0.36,0.43,0.56),(0.5,0.66),(0.3,0.72,0.89)]
+
+# fluorescence lines as fractions of the XRF channel axis
+LINES = [0.12,0.31,0.33,0.58]
+
+def phase_maps(rows,columns,n,rng):
+    """
+    Smooth concentration maps of n phases.
+    """
+    y,x = meshgrid(linspace(0,1,rows),linspace(0,1,columns),indexing='ij')
+    maps = [0.5 + 0.5 * exp(-((x - rng.random())**2 + (y - rng.random())**2) / 0.1) for _ in range(n)]
+
+    return stack(maps,-1)
+
+def xrd_frames(rows,columns,channels,seed=0):
+    """
+    Poisson counts of the phase reflections on a decaying background, (rows * columns,channels).
+
+    Every pixel is shifted by up to 3 channels, as the alignment expects.
+    """
+    rng = default_rng(seed)
+    c = arange(channels)
+    maps = phase_maps(rows,columns,len(PHASES),rng).reshape(-1,len(PHASES))
+    shift = rng.integers(-3,4,(rows * columns,1))
+
+    background = 50 * exp(-c / (channels / 2))
+    spectra = background + 0 * shift
+    for phase,concentration in zip(PHASES,maps.T):
+        for i,position in enumerate(phase):
+            peak = exp(-0.5 * ((c - shift - channels * position) / (3 + i))**2)
+            spectra = spectra + 300 / (i + 1) * concentration[:,None] * peak
+
+    return rng.poisson(spectra)
+
+def xrf_lines(rows,columns,channels,seed=0):
+    """
+    Poisson counts of the fluorescence lines, (rows,columns,channels).
+    """
+    rng = default_rng(seed + 1)
+    c = arange(channels)
+    maps = phase_maps(rows,columns,len(LINES),rng)
+
+    spectra = 5 + 0 * maps[:,:,:1]
+    for i,position in enumerate(LINES):
+        spectra = spectra + 1000 * maps[:,:,i:i + 1] * exp(-0.5 * ((c - channels * position) / 8)**2)
+
+    return rng.poisson(spectra).astype(uint32)
+
+def write_edf(name,x):
+    """
+    Write a 2D array as an EDF file with a 512 byte header.
+    """
+    x = x.astype(x.dtype.newbyteorder('<'))
+    types = {'u4':'UnsignedInteger','f4':'FloatValue','f8':'DoubleValue','u2':'UnsignedShort'}
+
+    text = '{\nHeaderID = EH:000001:000000:000000 ;\nEDF_Header_Size = 512 ;\nImage = 1 ;\nByteOrder = LowByteFirst ;\n'
+    text += 'DataType = %s ;\nDim_1 = %d ;\nDim_2 = %d ;\nSize = %d ;\n'%(types[x.dtype.str[1:]],x.shape[1],x.shape[0],x.nbytes)
+    text = text.ljust(510) + '}\n'
+
+    with open(name,'wb') as f:
+        f.write(text.encode('ascii'))
+        f.write(x.tobytes())
+
+def write_scan(path,rows=20,columns=30,channels=1280,xrf_channels=2048,seed=0,xrf=True):
+    """
+    Write a synthetic scan: Frame*.dat, Scanning_Parameters.txt and calibration.ini
+    in path and, with xrf, one EDF file per map row in path/xrf.
+    """
+    os.makedirs(path,exist_ok=True)
+
+    with open(os.path.join(path,'Scanning_Parameters.txt'),'w') as f:
+        f.write('NAME=synthetic\nAXIS: x STEP: %d\nAXIS: y STEP: %d\n'%(columns,rows))
+
+    with open(os.path.join(path,'calibration.ini'),'w') as f:
+        for channel,theta in CALIBRATION:
+            f.write('%d %.2f\n'%(channel * channels // 1280,theta))
+
+    c = arange(channels)
+    for i,counts in enumerate(xrd_frames(rows,columns,channels,seed)):
+        savetxt(os.path.join(path,'Frame%d.dat'%i),c_[c,counts],fmt='%d')
+
+    if xrf:
+        os.makedirs(os.path.join(path,'xrf'),exist_ok=True)
+        for i,line in enumerate(xrf_lines(rows,columns,xrf_channels,seed)):
+            write_edf(os.path.join(path,'xrf','synthetic_Z0_%04d.edf'%i),line)
+
+    return path
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('path')
+    parser.add_argument('--shape',nargs=3,default=[20,30,1280],type=int,help='map rows, map columns and channels')
+    parser.add_argument('--xrf-channels',default=2048,type=int)
+    parser.add_argument('--seed',default=0,type=int)
+    parser.add_argument('--no-xrf',dest='xrf',action='store_false')
+    args = parser.parse_args()
+
+    rows,columns,channels = args.shape
+    write_scan(args.path,rows,columns,channels,args.xrf_channels,args.seed,args.xrf)
+
+if __name__ == '__main__':
+    main()
@@ -1,27 +1,9 @@
 #!/usr/bin/env python
 from src.xrd_data import DataXRD,Preprocessing
-from src.roi import MyROI
-from src.mainwindow import MainWindow
-
-from pyqtgraph import exec as exec_
-from pyqtgraph import functions as fn
-from pyqtgraph import mkQApp,GraphicsLayoutWidget,setConfigOptions
-from pyqtgraph import GraphicsView,ViewBox,Point,PlotItem,ImageItem,AxisItem,ROI,LinearRegionItem,GraphicsLayout
-from pyqtgraph.Qt import QtCore,QtWidgets,QtGui
-
-from numpy import uint8,array,asarray,stack,savetxt,c_,pad,where,minimum,sqrt
-from numpy.random import random,randint
-from itertools import cycle
-
-from pathlib import Path
-from scipy import signal
-import os
-
-from matplotlib.image import imsave
+from src.export import export_edf,export_ascii
+from src.stages import configure,MODES
 
 from argparse import ArgumentParser
-import h5py
-from numpy import concatenate
 
 def main():
     """
@@ -35,10 +17,16 @@ def main():
     parser.add_argument('-s','--shift-y',default=0,help='shift correction',type=int)
     parser.add_argument('-l','--load',action='store_true')
     parser.add_argument('-z','--shift-z',default = 0,type=int)
+    parser.add_argument('-w','--workers',default=None,help='number of reader workers',type=int)
     parser.add_argument('--asci',action='store_true')
+    parser.add_argument('-o','--output',default='file1.edf',help='EDF file')
+    parser.add_argument('-r','--rows',default=8,help='map rows written per block',type=int)
+    parser.add_argument('--profile',default='progress',choices=MODES,help='stage report: progress messages, a table of the stage timings at exit, JSON lines or nothing')
+    parser.add_argument('--profile-output',default=None,help='file of the JSON lines, stderr by default')
 
     args = parser.parse_args()
     kwargs = vars(args)
+    configure(kwargs.pop('profile'),kwargs.pop('profile_output'))
 
     print(args)
     print('Source data directory:',args.path)
@@ -49,11 +37,13 @@ def main():
     load = kwargs.pop('load')
     shift_y = kwargs.pop('shift_y')
     shift_z = kwargs.pop('shift_z')
-    #save_h5 = kwargs.pop('h5')
+    workers = kwargs.pop('workers')
     save_asci = kwargs.pop('asci')
+    output = kwargs.pop('output')
+    rows = kwargs.pop('rows')
 
     if load is False:
-        data = DataXRD(**kwargs).from_source()
+        data = DataXRD(**kwargs).from_source(workers)
         data.save_h5()
 
         if shift_z != 0:
@@ -62,88 +52,22 @@ def main():
             data.inverted = Preprocessing.apply_shift_z(data.inverted,shift)
 
     else:
-        data = DataXRD(**kwargs).load_h5()
+        data = DataXRD(**kwargs).load_h5(workers=workers,lazy=True)
 
         if shift_z != 0:
-            shift = Preprocessing.shift_z(data.convoluted,channel = shift_z)
-            data.convoluted = Preprocessing.apply_shift_z(data.convoluted,shift)
-            data.inverted = Preprocessing.apply_shift_z(data.inverted,shift)
+            shift = Preprocessing.shift_z(data.convoluted[()],channel = shift_z)
+            data.convoluted = Preprocessing.apply_shift_z(data.convoluted[()],shift)
+            data.inverted = Preprocessing.apply_shift_z(data.inverted[()],shift)
 
     data.calibrate(n_channels=data.shape[-1])
+    data.shift_y = shift_y
 
-    print(data.inverted.shape)
-    print(data.calibration.cx,len(data.calibration.cx))
-
-    tmp_data = data.inverted.reshape(-1,1280).astype(float)
-    
-    try:
-        os.mkdir('converted')
-    except:
-        pass
-
-    #print(tmp_data.shape,data.inverted.shape)
-    #print(len(tmp_data))
-
-
-    text ="""{
-HeaderID = EH:000001:000000:000000 ;
-EDF_Header_Size = 512 ;
-Image = 0 ;
-ByteOrder = LowByteFirst ;
-DataType = DoubleValue ;
-Dim_1 = 1280 ;
-Dim_2 = 16151 ;
-Size = 20673280 ;
-xrdua_1d = True ;
-"""
-
-    print(text)
-
-    g = concatenate((array([data.calibration.cx]),tmp_data))
-
-    with open('file1.edf','w') as f:
-        f.write(text)
-        print('FTELL',f.tell())
-        while f.tell() < 510:
-            f.write(' ')
-        f.write('}\n')
-        print('FTELL',f.tell())
-
-        f.close()
-
-    print(g.shape)
-
-    with open('file1.edf','ab') as f:
-        f.seek(512)
-        g.astype(float).tofile(f)
-        f.close()
- 
-    exit()
-    
-
-    #if save_h5:
-    #print('Saving h5')
-    #tmp_cx = array([data.calibration.cx] * len(tmp_data))
-    #cx = tmp_cx.reshape(*data.inverted.shape)
-
-    #print(array([data.calibration.cx]).shape,tmp_data.shape)
-
-    #g = concatenate((array([data.calibration.cx]),tmp_data))
-
-   # with h5py.File('converted/cdata.h5','w') as f:
-
-    #    f.create_dataset('flat_inverted',data = tmp_data)
-    #    f.create_dataset('flat_calibration_inverted',data = tmp_cx)
+    print(data.view_shape)
 
-    #    f.create_dataset('inverted',data = data.inverted)
-    #    f.create_dataset('calibration_inverted',data = cx)
-    #    f.create_dataset('cx',data = data.calibration.cx)
-    #    f.create_dataset('g',data = g)
+    export_edf(data,output,rows)
 
     if save_asci:
-        print('Saving ASCI')
-        for i,t in enumerate(tmp_data):
-            savetxt('converted/CFrame%04d.dat'%i,c_[data.calibration.cx,t],fmt='%.4f %d')
+        export_ascii(data,'converted',rows,workers)
 
 if __name__ == '__main__':
     try:
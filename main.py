@@ -1,23 +1,12 @@
 #!/usr/bin/env python
 from src.xrd_data import DataXRD,Preprocessing
-from src.roi import MyROI
-from src.mainwindow import MainWindow
+from src.live import LiveScan
+from src.stages import configure,MODES
 
-from pyqtgraph import exec as exec_
-from pyqtgraph import functions as fn
-from pyqtgraph import mkQApp,GraphicsLayoutWidget,setConfigOptions
-from pyqtgraph import GraphicsView,ViewBox,Point,PlotItem,ImageItem,AxisItem,ROI,LinearRegionItem,GraphicsLayout
-from pyqtgraph.Qt import QtCore,QtWidgets,QtGui
-
-from numpy import uint8,array,asarray,stack,savetxt,c_,pad,where,minimum,sqrt
-from numpy.random import random,randint
-from itertools import cycle
-
-from scipy import signal
-
-from matplotlib.image import imsave
+from numpy import int64,float64
 
 from argparse import ArgumentParser
+from time import sleep
 
 def main():
     """
@@ -31,9 +20,26 @@ def main():
     parser.add_argument('-s','--shift-y',default=0,help='shift correction',type=int)
     parser.add_argument('-l','--load',action='store_true')
     parser.add_argument('-z','--shift-z',default = 0,type=int)
+    parser.add_argument('-a','--align',default = 0,help='align the pixel spectra to the reflection at this channel',type=int)
+    parser.add_argument('--refine',default = None,choices = ['parabolic','centroid'],help='sub-channel alignment')
+    parser.add_argument('-w','--workers',default=None,help='number of reader workers',type=int)
+    parser.add_argument('--stream',action='store_true',help='write data.h5 block by block and keep it open, as --lazy')
+    parser.add_argument('--rows',default=8,help='map rows per streamed block',type=int)
+    parser.add_argument('-t','--tile',default=8,help='map rows per preprocessing tile',type=int)
+    parser.add_argument('--layout',default=None,choices=['contiguous','chunked'],help='data.h5 layout, chunked is compressed with narrow dtypes, contiguous by default and an existing data.h5 keeps its own')
+    parser.add_argument('--compression',default='gzip',choices=['gzip','lzf'],help='compression of the chunked layout')
+    parser.add_argument('--live',action='store_true',help='read the frames of a running scan as they arrive')
+    parser.add_argument('--interval',default=1000,help='polling interval of the live mode in ms',type=int)
+    parser.add_argument('--rebuild',action='store_true',help='rebuild data.h5 from all source files instead of patching the changed ones')
+    parser.add_argument('--lazy',action='store_true',help='keep data.h5 open and read only the slices displayed')
+    parser.add_argument('--wide',action='store_true',help='keep the counts as int64 and the derived cubes as float64')
+    parser.add_argument('--no-index',dest='index',action='store_false',help='do not keep the index tables for band images and ROI spectra')
+    parser.add_argument('--profile',default='progress',choices=MODES,help='stage report: progress messages, a table of the stage timings at exit, JSON lines or nothing')
+    parser.add_argument('--profile-output',default=None,help='file of the JSON lines, stderr by default')
 
     args = parser.parse_args()
     kwargs = vars(args)
+    configure(kwargs.pop('profile'),kwargs.pop('profile_output'))
 
     print(args)
     print('Source data directory:',args.path)
@@ -44,35 +50,79 @@ def main():
     load = kwargs.pop('load')
     shift_y = kwargs.pop('shift_y')
     shift_z = kwargs.pop('shift_z')
-
-    if load is False:
-        data = DataXRD(**kwargs).from_source()
-        data.save_h5()
+    align = kwargs.pop('align')
+    refine = kwargs.pop('refine')
+    workers = kwargs.pop('workers')
+    stream = kwargs.pop('stream')
+    rows = kwargs.pop('rows')
+    tile = kwargs.pop('tile')
+    layout = kwargs.pop('layout')
+    compression = kwargs.pop('compression')
+    lazy = kwargs.pop('lazy')
+    rebuild = kwargs.pop('rebuild')
+    live = kwargs.pop('live')
+    interval = kwargs.pop('interval')
+
+    if live is True and (align != 0 or shift_z != 0):
+        parser.error('--live cannot be combined with -a or -z')
+
+    if kwargs.pop('wide'):
+        kwargs.update(counts=int64,floats=float64)
+
+    if live is True:
+        data = DataXRD(**kwargs)
+        scan = LiveScan(data,workers,tile)
+
+        print('Waiting for frames in',args.path)
+        while scan.poll() == 0:
+            sleep(interval / 1000)
+
+    elif load is False:
+        data = DataXRD(**kwargs)
+
+        if rebuild is False and data.update_h5(workers=workers,tile=tile,layout=layout,compression=compression):
+            data.load_h5(workers=workers,tile=tile,lazy=lazy or stream)
+        elif stream is True:
+            data.stream_h5(rows=rows,workers=workers,tile=tile).load_h5(workers=workers,tile=tile,lazy=True)
+        else:
+            data.from_source(workers,tile)
+            if align != 0:
+                data.shift_z(align,refine)
+            data.save_h5(layout=layout or 'contiguous',compression=compression)
 
         if shift_z != 0:
-            shift = Preprocessing.shift_z(data.convoluted,channel = shift_z)
-            data.convoluted = Preprocessing.apply_shift_z(data.convoluted,shift)
-            data.inverted = Preprocessing.apply_shift_z(data.inverted,shift)
+            shift = Preprocessing.shift_z(data.convoluted[()],channel = shift_z)
+            data.convoluted = Preprocessing.apply_shift_z(data.convoluted[()],shift)
+            data.inverted = Preprocessing.apply_shift_z(data.inverted[()],shift)
 
     else:
-        data = DataXRD(**kwargs).load_h5()
+        data = DataXRD(**kwargs).load_h5(workers=workers,tile=tile,lazy=lazy)
 
         if shift_z != 0:
-            shift = Preprocessing.shift_z(data.convoluted,channel = shift_z)
-            data.convoluted = Preprocessing.apply_shift_z(data.convoluted,shift)
-            data.inverted = Preprocessing.apply_shift_z(data.inverted,shift)
+            shift = Preprocessing.shift_z(data.convoluted[()],channel = shift_z)
+            data.convoluted = Preprocessing.apply_shift_z(data.convoluted[()],shift)
+            data.inverted = Preprocessing.apply_shift_z(data.inverted[()],shift)
+
+    if align != 0 and data.preprocessing.get('align') != {'channel':align,'refine':refine}:
+        data.shift_z(align,refine)
 
     data.calibrate(n_channels=data.shape[-1])
-    data.snip = Preprocessing.snip(data.convoluted,24)
-    data.snipped = data.inverted - data.snip
-    data.snipped[data.snipped < 0] = 0
+    data.subtract_background(24,workers=workers,tile=tile)
+
+    data.shift_y = shift_y
 
     """
     Open window
     """
+    from src.mainwindow import MainWindow
+    from pyqtgraph import mkQApp,exec as exec_
+
     app = mkQApp()
     window = MainWindow(data)
 
+    if live is True:
+        window.setLive(scan,interval)
+
     exec_()
 
 if __name__ == '__main__':
@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+from src.render import read_config,render_scans
+from src.stages import configure,MODES
+
+from argparse import ArgumentParser
+
+def main():
+    """
+    Render band maps and ROI spectra of one or more scans without opening the viewer
+    """
+    parser = ArgumentParser()
+
+    parser.add_argument('paths',nargs='+',help='scan directories')
+    parser.add_argument('-b','--bands',required=True,help='JSON or INI file of bands and ROIs')
+    parser.add_argument('-o','--output',default=None,help='output directory, <scan>/render by default')
+    parser.add_argument('--parameters',default='Scanning_Parameters.txt',help='scanning parameters file')
+    parser.add_argument('-c','--calibration',default='calibration.ini',help='calibration file')
+    parser.add_argument('-s','--shift-y',default=0,help='shift correction',type=int)
+    parser.add_argument('-l','--load',action='store_true')
+    parser.add_argument('-j','--jobs',default=None,help='number of scans rendered in parallel',type=int)
+    parser.add_argument('-w','--workers',default=1,help='number of reader workers per scan',type=int)
+    parser.add_argument('-t','--tile',default=8,help='map rows per preprocessing tile',type=int)
+    parser.add_argument('--no-index',dest='index',action='store_false',help='do not keep the index tables for band images and ROI spectra')
+    parser.add_argument('--profile',default='progress',choices=MODES,help='stage report: progress messages, a table of the stage timings at exit, JSON lines or nothing')
+    parser.add_argument('--profile-output',default=None,help='file of the JSON lines, stderr by default')
+
+    args = parser.parse_args()
+    kwargs = vars(args)
+    configure(kwargs.pop('profile'),kwargs.pop('profile_output'))
+
+    print(args)
+
+    paths = kwargs.pop('paths')
+    config = read_config(kwargs.pop('bands'))
+
+    for output in render_scans(paths,config,**kwargs):
+        print('Rendered:',output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+"""
+Scans stored as zip or tar archives, read without extraction.
+"""
+from io import TextIOWrapper,BytesIO
+from fnmatch import fnmatch
+import tarfile
+import zipfile
+import os
+
+ARCHIVES = ('.zip','.tar','.tar.gz','.tgz','.tar.bz2','.tbz2','.tar.xz','.txz')
+
+# bytes kept of every tar member that is not a frame
+HEAD_SIZE = 2**16
+
+listings = {}
+heads = {}
+
+def is_archive(path):
+    """
+    True if path is a zip or tar archive file.
+    """
+    return os.path.isfile(path) and path.lower().endswith(ARCHIVES)
+
+def archive_stem(path):
+    """
+    path without its archive extension.
+    """
+    for extension in sorted(ARCHIVES,key=len,reverse=True):
+        if path.lower().endswith(extension):
+            return path[:-len(extension)]
+
+    return path
+
+def archive_key(path):
+    """
+    Key of the archive in the caches, its path, size and modification time.
+    """
+    stat = os.stat(path)
+    return (os.path.abspath(path),stat.st_size,stat.st_mtime_ns)
+
+def archive_names(path):
+    """
+    Names of the files in the archive, in archive order.
+
+    The listing is kept per archive size and modification time. A tar is
+    listed in a single pass, which also keeps the first HEAD_SIZE bytes of
+    every member but the Frame*.dat files: the side files, e.g. the scanning
+    parameters and the calibration, and the EDF headers, so that a compressed
+    tar is not decompressed again to read them.
+    """
+    key = archive_key(path)
+
+    if key not in listings:
+        if zipfile.is_zipfile(path):
+            with zipfile.ZipFile(path) as f:
+                listings[key] = [info.filename for info in f.infolist() if not info.is_dir()]
+            heads[key] = {}
+        else:
+            names,head = [],{}
+            with tarfile.open(path,'r|*') as f:
+                for member in f:
+                    if not member.isfile():
+                        continue
+
+                    names += [member.name]
+                    if not fnmatch(os.path.basename(member.name),'F*.dat'):
+                        head[member.name] = (f.extractfile(member).read(HEAD_SIZE),member.size)
+
+            listings[key],heads[key] = names,head
+
+    return listings[key]
+
+def iter_members(path,names):
+    """
+    Yield (name,content) of the members in names, in archive order.
+
+    Every member is decompressed once and a tar is read as a stream, so
+    nothing is extracted and nothing is read twice.
+    """
+    names = set(names)
+
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as f:
+            for info in f.infolist():
+                if info.filename in names:
+                    yield info.filename,f.read(info)
+
+    else:
+        with tarfile.open(path,'r|*') as f:
+            for member in f:
+                if member.isfile() and member.name in names:
+                    yield member.name,f.extractfile(member).read()
+
+def read_member(path,name):
+    """
+    Content of a single member, kept from the listing if it is small.
+    """
+    archive_names(path)
+    content,size = heads[archive_key(path)].get(name,(b'',None))
+    if len(content) == size:
+        return content
+
+    for _,content in iter_members(path,[name]):
+        return content
+
+    raise KeyError('%s is not in %s'%(name,path))
+
+def read_head(path,name):
+    """
+    The first HEAD_SIZE bytes of a member, e.g. an EDF header.
+    """
+    archive_names(path)
+    if name in heads[archive_key(path)]:
+        return heads[archive_key(path)][name][0]
+
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as f,f.open(name) as member:
+            return member.read(HEAD_SIZE)
+
+    return read_member(path,name)[:HEAD_SIZE]
+
+def open_member(path,name):
+    """
+    Text file of a single member.
+    """
+    return TextIOWrapper(BytesIO(read_member(path,name)))
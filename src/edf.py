@@ -0,0 +1,185 @@
+from numpy import memmap,dtype,prod,frombuffer
+import sys
+
+DATA_TYPES = {
+    'UnsignedByte':'u1',
+    'SignedByte':'i1',
+    'UnsignedShort':'u2',
+    'SignedShort':'i2',
+    'UnsignedInteger':'u4',
+    'SignedInteger':'i4',
+    'UnsignedLong':'u4',
+    'SignedLong':'i4',
+    'Unsigned64':'u8',
+    'Signed64':'i8',
+    'FloatValue':'f4',
+    'Float':'f4',
+    'DoubleValue':'f8',
+    'Double':'f8',
+}
+
+BYTE_ORDERS = {
+    'LowByteFirst':'<',
+    'HighByteFirst':'>',
+}
+
+TYPE_NAMES = {
+    'u1':'UnsignedByte',
+    'i1':'SignedByte',
+    'u2':'UnsignedShort',
+    'i2':'SignedShort',
+    'u4':'UnsignedInteger',
+    'i4':'SignedInteger',
+    'u8':'Unsigned64',
+    'i8':'Signed64',
+    'f4':'FloatValue',
+    'f8':'DoubleValue',
+}
+
+def read_header(name):
+    """
+    Parse the {...} header of an EDF file.
+
+    Parameters
+    ---------
+    name: str
+        name of the EDF file.
+
+    Returns
+    -------
+    dictionary
+        header keys and values as strings, plus 'offset', 'shape' and
+        'dtype' describing the binary body.
+    """
+    with open(name,'rb') as f:
+        block = f.read(512)
+        while b'}' not in block:
+            more = f.read(512)
+            if not more:
+                raise ValueError('%s: EDF header is not terminated'%name)
+            block += more
+
+    return parse_header(block,name)
+
+def parse_header(block,name='EDF'):
+    """
+    Parse the {...} header at the start of the bytes block, see read_header.
+    """
+    if b'}' not in block:
+        raise ValueError('%s: EDF header is not terminated'%name)
+
+    end = block.index(b'}') + 1
+    if block[end:end + 1] == b'\n':
+        end += 1
+
+    header = {}
+    text = block[block.index(b'{') + 1:block.index(b'}')].decode('ascii','replace')
+    for item in text.split(';'):
+        if '=' in item:
+            key,value = item.split('=',1)
+            header[key.strip()] = value.strip()
+
+    header['offset'] = int(header.get('EDF_Header_Size',end))
+
+    if 'Dim_2' in header:
+        header['shape'] = (int(header['Dim_2']),int(header['Dim_1']))
+    else:
+        header['shape'] = (int(header['Dim_1']),)
+
+    order = BYTE_ORDERS.get(header.get('ByteOrder'),'=')
+    header['dtype'] = dtype(DATA_TYPES[header.get('DataType','DoubleValue')]).newbyteorder(order)
+
+    return header
+
+def edf_body(content,header=None):
+    """
+    Zero-copy view of the body of an EDF file read as bytes, e.g. an archive member.
+    """
+    if header is None:
+        header = parse_header(content)
+
+    return frombuffer(content,dtype=header['dtype'],count=int(prod(header['shape'])),offset=header['offset']).reshape(header['shape'])
+
+def memmap_edf(name,header=None):
+    """
+    Zero-copy view of the body of an EDF file.
+
+    Parameters
+    ---------
+    name: str
+        name of the EDF file.
+    header: dictionary
+        header returned by read_header, parsed from the file if None.
+
+    Returns
+    -------
+    numpy memmap
+        read-only array of shape (Dim_2,Dim_1)
+    """
+    if header is None:
+        header = read_header(name)
+
+    return memmap(name,dtype=header['dtype'],mode='r',offset=header['offset'],shape=header['shape'])
+
+def edf_header(shape,data_type,**keys):
+    """
+    EDF header of a (Dim_2,Dim_1) image, padded to a multiple of 512 bytes.
+
+    Parameters
+    ---------
+    shape: tuple
+        (Dim_2,Dim_1) shape of the body.
+    data_type: dtype
+        dtype of the body.
+    keys:
+        further header keys, e.g. xrdua_1d = True.
+
+    Returns
+    -------
+    bytes
+        the header
+    """
+    data_type = dtype(data_type)
+    big = data_type.byteorder == '>' or (data_type.byteorder == '=' and sys.byteorder == 'big')
+
+    items = [('Image',0),('ByteOrder','HighByteFirst' if big else 'LowByteFirst'),
+        ('DataType',TYPE_NAMES[data_type.kind + str(data_type.itemsize)]),
+        ('Dim_1',shape[1]),('Dim_2',shape[0]),('Size',int(prod(shape)) * data_type.itemsize)] + list(keys.items())
+    text = ''.join('%s = %s ;\n'%item for item in items)
+
+    head = '{\nHeaderID = EH:000001:000000:000000 ;\nEDF_Header_Size = %d ;\n'
+    size = 512 * ((len(head%0) + 8 + len(text) + 2) // 512 + 1)
+    text = (head%size + text).ljust(size - 2) + '}\n'
+
+    return text.encode('ascii')
+
+def create_edf(name,shape,data_type,**keys):
+    """
+    Create an EDF file and map its body for writing.
+
+    The header is derived from the shape and dtype, the body is written
+    through the returned memmap, e.g. block by block.
+
+    Parameters
+    ---------
+    name: str
+        name of the EDF file.
+    shape: tuple
+        (Dim_2,Dim_1) shape of the body.
+    data_type: dtype
+        dtype of the body.
+    keys:
+        further header keys.
+
+    Returns
+    -------
+    numpy memmap
+        writable array of shape (Dim_2,Dim_1)
+    """
+    header = edf_header(shape,data_type,**keys)
+
+    with open(name,'wb') as f:
+        f.write(header)
+        f.truncate(len(header) + int(prod(shape)) * dtype(data_type).itemsize)
+
+    return memmap(name,dtype=data_type,mode='r+',offset=len(header),shape=shape)
@@ -0,0 +1,96 @@
+"""
+Export of the y-shifted cube to XRDUA: one EDF file and ASCII frames.
+"""
+from src.xrd_data import pool
+from src.edf import create_edf
+from src.stages import stage
+
+from numpy import float64
+from concurrent.futures import ProcessPoolExecutor
+import os
+
+def export_edf(data,name,rows=8,dtype=float64):
+    """
+    Write the y-shifted inverted cube as an XRDUA 1D EDF file.
+
+    The first EDF row is the 2 theta axis, then one spectrum per pixel. The
+    header follows from the shape of the cube and the body is written `rows`
+    map rows at a time, so the cube is never copied as a whole.
+
+    Parameters
+    ---------
+    data: DataXRD
+        calibrated data, lazy or in memory.
+    name: str
+        name of the EDF file.
+    rows: int
+        map rows per block.
+    dtype: dtype
+        EDF data type, DoubleValue by default.
+    """
+    n_rows,n_columns,n_channels = data.view_shape
+
+    with stage('export_edf','Saving EDF %s'%name,shape=data.view_shape):
+        out = create_edf(name,(n_rows * n_columns + 1,n_channels),dtype,xrdua_1d='True')
+        out[0] = data.calibration.cx
+
+        for start in range(0,n_rows,rows):
+            stop = min(start + rows,n_rows)
+            out[1 + start * n_columns:1 + stop * n_columns] = data.view_block('inverted',start,stop).reshape(-1,n_channels)
+
+        out.flush()
+        del out
+
+def ascii_template(cx):
+    """
+    Format string of an ASCII frame: the fixed 2 theta column and one %d per channel.
+    """
+    return ''.join('%.4f %%d\n'%theta for theta in cx)
+
+def write_ascii(template,names,frames):
+    """
+    Write frames as ASCII files, one string formatting per frame.
+    """
+    for name,frame in zip(names,frames):
+        with open(name,'w') as f:
+            f.write(template%tuple(frame.tolist()))
+
+def export_ascii(data,path,rows=8,workers=None):
+    """
+    Write every pixel of the y-shifted inverted cube as path/CFrame%04d.dat.
+
+    Blocks of `rows` map rows are formatted on `workers` processes, at most
+    two blocks per worker are pending at a time.
+
+    Parameters
+    ---------
+    data: DataXRD
+        calibrated data, lazy or in memory.
+    path: str
+        output directory.
+    rows: int
+        map rows per block.
+    workers: int
+        number of processes, None for the number of CPUs and 1 for serial.
+    """
+    n_rows,n_columns,n_channels = data.view_shape
+    template = ascii_template(data.calibration.cx)
+    os.makedirs(path,exist_ok=True)
+
+    with stage('export_ascii','Saving ASCI %s'%path,shape=data.view_shape),pool(workers,ProcessPoolExecutor) as executor:
+        pending = []
+        for start in range(0,n_rows,rows):
+            stop = min(start + rows,n_rows)
+            frames = data.view_block('inverted',start,stop).reshape(-1,n_channels)
+            names = [os.path.join(path,'CFrame%04d.dat'%i) for i in range(start * n_columns,stop * n_columns)]
+
+            if executor is None:
+                write_ascii(template,names,frames)
+                continue
+
+            pending += [executor.submit(write_ascii,template,names,frames)]
+            if len(pending) > 2 * (workers or os.cpu_count()):
+                pending.pop(0).result()
+
+        for future in pending:
+            future.result()
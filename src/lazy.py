@@ -0,0 +1,41 @@
+"""
+Modules imported on first use, so that importing the library stays fast.
+"""
+from importlib import import_module
+
+modules = []
+
+class LazyModule():
+    """
+    Stand-in for the module `name`, imported on the first attribute access.
+
+        signal = LazyModule('scipy.signal')
+        signal.windows.gaussian(95,3)   # scipy.signal is imported here
+    """
+    def __init__(self,name):
+        self._name = name
+        self._module = None
+        modules.append(self)
+
+    def __getattr__(self,attr):
+        if attr in ('_name','_module'):
+            raise AttributeError(attr)
+
+        return getattr(self._load(),attr)
+
+    def _load(self):
+        if self._module is None:
+            self._module = import_module(self._name)
+
+        return self._module
+
+    def __repr__(self):
+        return '<lazy module %s%s>'%(self._name,'' if self._module is None else ', imported')
+
+def import_all():
+    """
+    Import every lazy module now, e.g. before the stages are profiled, so
+    that no stage is charged with an import.
+    """
+    for module in modules:
+        module._load()
@@ -0,0 +1,108 @@
+"""
+Live acquisition: the frames of a running scan are read as they arrive.
+"""
+from src.xrd_data import read_frames,frame_pixels,narrow_dtype
+from src.stages import stage
+
+from numpy import zeros,result_type
+from concurrent.futures import ProcessPoolExecutor
+import os
+
+class LiveScan():
+    """
+    Frames of a running scan read into preallocated cubes of the final map shape.
+
+    Every poll lists the Frame*.dat files and reads those not read yet whose
+    size did not change since the previous poll, i.e. which are completely
+    written. The frames are expected to arrive in frame order: a frame is
+    placed by its rank, as read_xrd, reshape and invert place it, and only the
+    new pixels are smoothed and background subtracted, see DataXRD.patch.
+
+    The reader processes are started once and shut down when the scan is
+    complete or on close.
+    """
+    def __init__(self,data,workers = 1,tile = 8):
+        self.data = data
+        self.workers = workers
+        self.tile = tile
+
+        self.read = set()
+        self.sizes = {}
+        self.executor = None
+
+        data.read_params()
+        self.n_rows,self.n_columns = data.params['y'],data.params['x']
+
+    @property
+    def complete(self):
+        return len(self.read) == self.n_rows * self.n_columns
+
+    def ready(self):
+        """
+        Sorted names of the frames and the ranks of the new, completely written ones.
+        """
+        names = self.data.xrd_names()
+        sizes = {name:os.path.getsize(name) for name in names if name not in self.read}
+
+        new = [i for i,name in enumerate(names[:self.n_rows * self.n_columns]) if name in sizes and sizes[name] > 0 and self.sizes.get(name) == sizes[name]]
+        self.sizes = sizes
+
+        return names,new
+
+    def reader(self):
+        """
+        The pool of reader processes, started on first use, None for serial reading.
+        """
+        if self.executor is None and self.workers != 1:
+            self.executor = ProcessPoolExecutor(self.workers)
+
+        return self.executor
+
+    def close(self):
+        """
+        Shut the reader processes down.
+        """
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def allocate(self,spectra):
+        """
+        Zero inverted and convoluted cubes of the final map shape.
+        """
+        data = self.data
+        shape = (self.n_rows,self.n_columns,spectra.shape[1])
+
+        data.inverted = zeros(shape,dtype=spectra.dtype if data.counts is None else data.counts)
+        data.convoluted = zeros(shape,dtype=data.floats)
+        data.shape = shape
+
+    def poll(self):
+        """
+        Read the new frames into the cubes, returns their number.
+        """
+        names,new = self.ready()
+        if not new:
+            return 0
+
+        data = self.data
+        with stage('live','Reading %d new frames'%len(new),frames=len(new)):
+            spectra = read_frames([names[i] for i in new],self.reader() if len(new) > 1 else None,data.counts is None)
+
+            if not hasattr(data,'inverted'):
+                self.allocate(spectra)
+
+            if data.counts is None:
+                dtype = result_type(data.inverted.dtype,narrow_dtype(spectra))
+                if dtype != data.inverted.dtype:
+                    data.inverted = data.inverted.astype(dtype)
+
+            rows,columns = frame_pixels(new,self.n_rows * self.n_columns,self.n_columns)
+            data.patch(rows,columns,spectra.astype(data.inverted.dtype,copy=False),self.workers,self.tile)
+
+            self.read.update(names[i] for i in new)
+
+        if self.complete:
+            self.close()
+
+        return len(new)
@@ -1,6 +1,8 @@
 from src.xrd_data import DataXRD,Preprocessing
 from src.roi import MyROI
 from src.viewbox import MyGLW,MyViewBox,MySpectraViewBox
+from src.worker import ComputeWorker
+from src.stages import stage,note
 
 from pyqtgraph import exec as exec_
 from pyqtgraph import functions as fn
@@ -8,8 +10,6 @@ from pyqtgraph import mkQApp,GraphicsLayoutWidget,setConfigOptions
 from pyqtgraph import GraphicsView,ViewBox,Point,PlotItem,ImageItem,AxisItem,ROI,LinearRegionItem,GraphicsLayout,ColorBarItem,HistogramLUTItem
 from pyqtgraph.Qt import QtCore,QtWidgets,QtGui
 
-from matplotlib.pyplot import imsave,cm
-
 from numpy import uint8,array,asarray,stack,savetxt,c_,pad,where,minimum,sqrt,argmin,round
 from numpy.random import random,randint
 from itertools import cycle
@@ -91,7 +91,7 @@ class MainWindow(QtWidgets.QMainWindow):
 
         else:
             self.intensity_plot.plot(self.data.spectra255,pen=fn.mkPen((255,166,166), width=1.666))
-            print(self.data.spectra255)
+            note(self.data.spectra255)
             self.intensity_plot.setLabel('bottom',text='Channel')
 
     def setSpectraPlot(self):
@@ -183,19 +183,15 @@ class MainWindow(QtWidgets.QMainWindow):
         self.keyPressed.connect(self.onKey)
         self.data = data
 
-        self.data._inverted = self.data.inverted
-        self.data._convoluted = self.data.convoluted
-
         self.mode = 0 
         self.selected = None
         self.speed_cycle = cycle([1,2,8,16]) 
         self.speed = 8
-        self.shift = 0
+        self.shift = self.data.shift_y
 
         self.calibration = False
 
-        self.data.inverted  = Preprocessing.shift_y(self.data._inverted,self.shift)
-        self.data.convoluted  = Preprocessing.shift_y(self.data._convoluted,self.shift)
+        self.worker = ComputeWorker(self)
 
         setConfigOptions(background='w',antialias=True,leftButtonPan=False,imageAxisOrder='row-major')
 
@@ -220,11 +216,51 @@ class MainWindow(QtWidgets.QMainWindow):
 
         self.show()
 
+    def setLive(self,scan,interval = 1000):
+        """
+        Poll the running scan every interval ms and redraw with its new frames.
+        """
+        self.scan = scan
+        self.timer = QtCore.QTimer(self)
+        self.timer.timeout.connect(self.liveUpdate)
+        self.timer.start(interval)
+
+    def liveUpdate(self):
+        """
+        Read the new frames of the scan, while no band image or ROI is computed.
+        """
+        if not self.worker.idle():
+            return
+
+        if self.scan.poll() == 0:
+            if self.scan.complete:
+                self.timer.stop()
+                print('Scan complete')
+            return
+
+        self.redrawIntensity()
+        self.redrawROI()
+        self.update()
+
+    def closeEvent(self,event):
+        self.worker.stop()
+        if hasattr(self,'scan'):
+            self.scan.close()
+        super().closeEvent(event)
+
     def redrawROI(self):
-        if self.image_plot.roi_list:
-            for roi in self.image_plot.roi_list:
-                roi.calculate()
-            roi.redraw()
+        for roi in self.image_plot.roi_list:
+            roi.roiUpdate()
+
+    def bandImage(self,data,x,subtract_snip):
+        """
+        Band image of the channels x, computed on the worker from a snapshot of the data.
+        """
+        with stage('band',left=x[0],right=x[1],snip=subtract_snip):
+            if subtract_snip == True:
+                return data.crop_snip_spectra(*x)
+            else:
+                return data.crop_spectra(*x)
 
     def monoUpdate(self):
         """
@@ -235,12 +271,13 @@ class MainWindow(QtWidgets.QMainWindow):
         if self.calibration:
             x  = self.data.calibration.ic(x)
 
-        if self.spectra_plot.subtract_snip == True:
-            self.data.image = self.data.crop_snip_spectra(*x)
-        else:
-            self.data.image = self.data.crop_spectra(*x)
+        subtract_snip = self.spectra_plot.subtract_snip
+        data = self.data.snapshot()
+        self.worker.submit('mono',lambda: self.bandImage(data,x,subtract_snip),self.setMonoImage)
+
+    def setMonoImage(self,image):
+        self.data.image = image
 
-        #self.data.image = self.data.crop_spectra(*x)
         if self.mode == 1:
             self.img.setImage(self.data.image)
 
@@ -248,7 +285,7 @@ class MainWindow(QtWidgets.QMainWindow):
         """
         RGB update
         """
-        image = []
+        bands = []
         region_x = []
         for region in self.rgb_region:
             x = asarray(region.getRegion()).astype(float)
@@ -258,31 +295,28 @@ class MainWindow(QtWidgets.QMainWindow):
             if self.calibration is True:
                 x  = self.data.calibration.ic(x)
 
-            if self.spectra_plot.subtract_snip == True:
-                image += [self.data.crop_snip_spectra(*x)]
-            else:
-                image += [self.data.crop_spectra(*x)]
+            bands += [x]
 
         self.intensity_plot.region_x = asarray(region_x)
 
-        rgb_image = stack(image,-1)
-        rgb_image = rgb_image.astype(uint8)
+        def rgbImage(subtract_snip = self.spectra_plot.subtract_snip,data = self.data.snapshot()):
+            image = [self.bandImage(data,x,subtract_snip) for x in bands]
+
+            rgb_image = stack(image,-1)
+            return rgb_image.astype(uint8)
 
+        self.worker.submit('rgb',rgbImage,self.setRGBImage)
+
+    def setRGBImage(self,rgb_image):
         if self.mode == 2:
             self.data.image = rgb_image 
             self.img.setImage(rgb_image)
 
-        #if self.mode == 3:
-        #    rgb_image = rgb_image.min(axis=2)
-
-        #    self.data.image = rgb_image 
-        #    self.img.setImage(rgb_image)
-
     def MultiUpdate(self):
         """
         RGB update
         """
-        image = []
+        bands = []
         region_x = []
         for region in self.multi_region:
             x = asarray(region.getRegion()).astype(float)
@@ -292,19 +326,21 @@ class MainWindow(QtWidgets.QMainWindow):
             if self.calibration is True:
                 x  = self.data.calibration.ic(x)
 
-            if self.spectra_plot.subtract_snip == True:
-                image += [self.data.crop_snip_spectra(*x)]
-            else:
-                image += [self.data.crop_spectra(*x)]
+            bands += [x]
 
         self.intensity_plot.region_x = asarray(region_x)
 
-        image = stack(image,-1)
-        image = image.astype(uint8)
-        image = image.min(axis=2)
+        def multiImage(subtract_snip = self.spectra_plot.subtract_snip,data = self.data.snapshot()):
+            image = [self.bandImage(data,x,subtract_snip) for x in bands]
 
-        if self.mode == 3:
+            image = stack(image,-1)
+            image = image.astype(uint8)
+            return image.min(axis=2)
 
+        self.worker.submit('multi',multiImage,self.setMultiImage)
+
+    def setMultiImage(self,image):
+        if self.mode == 3:
             self.data.image = image 
             self.img.setImage(image)
 
@@ -368,6 +404,7 @@ class MainWindow(QtWidgets.QMainWindow):
 
                 name = self.data.path + '/' + 'roi_crop_%d.tiff'%i
                 print('Saving ROI crop images',name)
+                from matplotlib.pyplot import imsave,cm
                 imsave(name,roi.crop(),cmap=cm.jet)
 
     def adjustSnip(self,event):
@@ -557,18 +594,18 @@ class MainWindow(QtWidgets.QMainWindow):
         if event.key() == QtCore.Qt.Key.Key_U:
             self.shift += 1
             print('Shift:',self.shift)
-            self.data.inverted  = Preprocessing.shift_y(self.data._inverted,self.shift)
-            self.data.convoluted  = Preprocessing.shift_y(self.data._convoluted,self.shift)
+            self.data.shift_y = self.shift
 
-            self.intensityUpdate()
+            with stage('shift_y',shift=self.shift):
+                self.intensityUpdate()
 
         if event.key() == QtCore.Qt.Key.Key_I:
             self.shift -= 1
             print('Shift:',self.shift)
-            self.data.inverted  = Preprocessing.shift_y(self.data._inverted,self.shift)
-            self.data.convoluted  = Preprocessing.shift_y(self.data._convoluted,self.shift)
+            self.data.shift_y = self.shift
 
-            self.intensityUpdate()
+            with stage('shift_y',shift=self.shift):
+                self.intensityUpdate()
     
     def setLogPlots(self,event):
 
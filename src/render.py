@@ -0,0 +1,189 @@
+"""
+Headless rendering of band maps and ROI spectra, without Qt.
+"""
+from src.xrd_data import DataXRD,Preprocessing,pool
+from src.stages import stage
+from src.archive import is_archive,archive_stem
+from src import stages
+
+from numpy import savetxt,c_
+from concurrent.futures import ProcessPoolExecutor
+from configparser import ConfigParser
+from PIL import Image
+import json
+import os
+
+def read_config(name):
+    """
+    Read the bands and ROIs to render.
+
+    JSON:
+        {"snip_m": 24,
+         "bands": [{"name": "a", "left": 500, "right": 520, "unit": "channel", "snip": false}],
+         "rois": [{"name": "r", "rows": [0, 10], "columns": [5, 20]}]}
+
+    INI:
+        [options]
+        snip_m = 24
+
+        [band:a]
+        left = 27.1
+        right = 27.6
+        unit = theta
+
+        [roi:r]
+        rows = 0,10
+        columns = 5,20
+
+    unit is 'channel' (default) or 'theta' for 2 theta, snip subtracts the
+    background. rows and columns are map pixels [start,stop) of the y-shifted map.
+
+    Returns
+    -------
+    dictionary
+        snip_m, bands and rois
+    """
+    if name.endswith('.json'):
+        with open(name,'r') as f:
+            config = json.load(f)
+
+    else:
+        parser = ConfigParser()
+        parser.read(name)
+
+        config = {'bands':[],'rois':[]}
+        if parser.has_option('options','snip_m'):
+            config['snip_m'] = parser.getint('options','snip_m')
+
+        for section in parser.sections():
+            kind,_,label = section.partition(':')
+            items = parser[section]
+
+            if kind == 'band':
+                config['bands'] += [{'name':label,'left':items.getfloat('left'),'right':items.getfloat('right'),
+                    'unit':items.get('unit','channel'),'snip':items.getboolean('snip',False)}]
+
+            elif kind == 'roi':
+                config['rois'] += [{'name':label,'rows':[int(i) for i in items['rows'].split(',')],
+                    'columns':[int(i) for i in items['columns'].split(',')]}]
+
+    config.setdefault('snip_m',24)
+    config.setdefault('bands',[])
+    config.setdefault('rois',[])
+
+    for band in config['bands']:
+        if band.get('unit','channel') not in ('channel','theta'):
+            raise ValueError('Unknown band unit: %s'%band['unit'])
+
+    return config
+
+def render(data,config,output):
+    """
+    Write the band maps and ROI spectra of a loaded and calibrated DataXRD.
+
+    Every band gives <name>.tiff, scaled to 0-255 as in the viewer, and
+    <name>.dat with the band sums. Every ROI gives roi_<name>.dat with the
+    2 theta, mean, smoothed mean and background columns.
+    """
+    os.makedirs(output,exist_ok=True)
+
+    if any(band.get('snip',False) for band in config['bands']) and not hasattr(data,'snipped'):
+        data.subtract_background(config['snip_m'])
+
+    for band in config['bands']:
+        x = [band['left'],band['right']]
+        if band.get('unit','channel') == 'theta':
+            x = data.calibration.ic(x)
+
+        name = 'snipped' if band.get('snip',False) else 'inverted'
+        left,right = int(x[0]),int(x[1])
+
+        with stage('band','Saving band %s'%band['name'],left=left,right=right,snip=name == 'snipped'):
+            image = data.crop_snip_spectra(left,right) if name == 'snipped' else data.crop_spectra(left,right)
+
+            Image.fromarray(image[::-1]).save(os.path.join(output,band['name'] + '.tiff'))
+            savetxt(os.path.join(output,band['name'] + '.dat'),data.band(name,left,right)[::-1],fmt='%0.3f')
+
+    for roi in config['rois']:
+        rows,columns = slice(*roi['rows']),slice(*roi['columns'])
+        n_rows,n_columns,_ = data.view_shape
+        pixels = max(len(range(*rows.indices(n_rows))) * len(range(*columns.indices(n_columns))),1)
+
+        name = os.path.join(output,'roi_%s.dat'%roi['name'])
+        with stage('roi','Saving ROI spectra %s'%name,rows=roi['rows'],columns=roi['columns']):
+            z = data.roi_spectra('inverted',rows,columns) / pixels
+            conv = data.roi_spectra('convoluted',rows,columns) / pixels
+            snip = Preprocessing.snip(conv,config['snip_m'])
+
+            savetxt(name,c_[data.calibration.cx,z,conv,snip],fmt='%0.3f')
+
+def render_scan(path,config,output=None,load=False,shift_y=0,workers=None,tile=8,report=None,**kwargs):
+    """
+    Read one scan, from data.h5 with load, and render it to output, <path>/render by default.
+
+    path may be a zip or tar archive of the scan, rendered to <archive>_render by default.
+
+    kwargs are passed to DataXRD, e.g. parameters or calibration. report are
+    the stages settings of a worker process, which then returns its stage
+    records with the output.
+    """
+    if report is not None:
+        stages.configure(*report)
+        del stages.records[:]
+
+    if output is None:
+        output = archive_stem(path) + '_render' if is_archive(path) else os.path.join(path,'render')
+
+    data = DataXRD(path,**kwargs)
+    if load:
+        data.load_h5(workers=workers,tile=tile,lazy=True)
+    else:
+        data.from_source(workers,tile)
+        data.save_h5()
+
+    data.calibrate(n_channels=data.shape[-1])
+    data.shift_y = shift_y
+
+    render(data,config,output)
+
+    if report is not None:
+        return output,stages.records
+
+    return output
+
+def render_scans(paths,config,output=None,jobs=None,**kwargs):
+    """
+    Render many scans on `jobs` processes, output/<scan name> for each scan if output is given.
+
+    Raises ValueError before anything is rendered if two scans have the same
+    output, e.g. a/scan and b/scan, or a scan and its archive.
+    """
+    def scan_output(path):
+        if output is None:
+            return None
+        return os.path.join(output,os.path.basename(archive_stem(os.path.normpath(path))))
+
+    outputs = {}
+    for path in paths:
+        name = scan_output(path)
+        if name is None:
+            name = archive_stem(path) + '_render' if is_archive(path) else os.path.join(path,'render')
+
+        name = os.path.abspath(name)
+        if name in outputs:
+            raise ValueError('%s and %s are both rendered to %s'%(outputs[name],path,name))
+        outputs[name] = path
+
+    with pool(jobs,ProcessPoolExecutor) as executor:
+        if executor is None:
+            return [render_scan(path,config,scan_output(path),**kwargs) for path in paths]
+
+        futures = [executor.submit(render_scan,path,config,scan_output(path),report=stages.settings(),**kwargs) for path in paths]
+
+        rendered = []
+        for future in futures:
+            name,records = future.result()
+            stages.records += records
+            rendered += [name]
+
+        return rendered
@@ -1,4 +1,5 @@
-from src.xrd_data import DataXRD 
+from src.xrd_data import DataXRD,Preprocessing
+from src.stages import stage
 from pyqtgraph import exec as exec_
 from pyqtgraph import functions as fn
 from pyqtgraph.Point import Point
@@ -6,7 +7,7 @@ from pyqtgraph import mkQApp,GraphicsLayoutWidget,setConfigOptions
 from pyqtgraph import GraphicsView,ViewBox,Point,PlotItem,ImageItem,AxisItem,ROI,LinearRegionItem,GraphicsLayout
 from pyqtgraph.Qt import QtCore,QtWidgets,QtGui
 
-from numpy import uint8,array,asarray,stack,savetxt,c_,pad,where,minimum,sqrt
+from numpy import uint8,array,asarray,stack,savetxt,c_,pad,where,minimum,sqrt,array_equal
 from numpy.random import random,randint
 
 class MouseDragHandler(object):
@@ -84,6 +85,9 @@ class MyROI(ROI):
         self.snip_pen = fn.mkPen(color, width=.66)
         self.conv_pen = fn.mkPen((0,0,0), width=1)
 
+        self.conv = None
+        self.snips = {}
+
     def setMain(self,main):
 
         self.main = main
@@ -151,40 +155,52 @@ class MyROI(ROI):
 
         return [x,y]
 
-    def calculate(self):
-        """
-        Roi
-        """
-        _y,_x = self.zgetArraySlice(self.data.integrated_spectra,self.img)
-        s1 = slice(*_x)
-        s2 = slice(*_y)
+    def slices(self):
+        _y,_x = self.zgetArraySlice(self.img.image,self.img)
+        return slice(*_x),slice(*_y)
 
-        z = self.data.inverted[s1,s2]
-        conv = self.data.convoluted[s1,s2]
+    def calculate(self,s1,s2,data,normalized,snip_m,previous):
+        """
+        Roi spectrum, its smoothed spectrum and the SNIP background of the latter.
 
-        print('roi shape:',z.shape)
+        Everything is passed at submit time: the slices, a snapshot of the
+        data, the plot settings and the (conv,snips) of the previous result,
+        whose backgrounds are reused while conv is unchanged. Nothing of the
+        ROI is read or written, so it runs on the worker and assign sets the
+        result on the GUI thread.
+        """
+        shape = data.view_shape
+        shape = (len(range(*s1.indices(shape[0]))),len(range(*s2.indices(shape[1]))),shape[2])
 
-        _res = (z.shape[0] * z.shape[1])
+        _res = (shape[0] * shape[1])
         if _res: 
-            res = 1.0 / (z.shape[0] * z.shape[1])
+            res = 1.0 / (shape[0] * shape[1])
         else:
             res = 1
 
-        self.z = z.sum(axis=0).sum(axis=0).astype(float)
-        self.conv = conv.sum(axis=0).sum(axis=0).astype(float)
+        with stage('roi','roi shape: %s'%(shape,),shape=shape):
+            z = data.roi_spectra('inverted',s1,s2).astype(float)
+            conv = data.roi_spectra('convoluted',s1,s2).astype(float)
 
-        if self.spectra_plot.normalized_roi == True:
-            res = 1000.0 / self.z.max()
+        if normalized == True:
+            res = 1000.0 / z.max()
 
-        self.z *= res
-        self.conv *= res
+        z *= res
+        conv *= res
 
-        self.snip_z = self.snip(self.conv)
+        conv_previous,snips = previous
+        snips = {} if conv_previous is None or not array_equal(conv,conv_previous) else dict(snips)
+        if snip_m not in snips:
+            snips[snip_m] = Preprocessing.snip(conv,snip_m)
 
-        return self.z
+        return z,conv,snips,snips[snip_m]
+
+    def assign(self,result):
+        self.z,self.conv,self.snips,self.snip_z = result
+        self.redraw()
 
     def crop(self):
-        _y,_x = self.zgetArraySlice(self.data.integrated_spectra,self.img)
+        _y,_x = self.zgetArraySlice(self.img.image,self.img)
         s1 = slice(*_x)
         s2 = slice(*_y)
         z = self.data.image[s1,s2]
@@ -192,24 +208,18 @@ class MyROI(ROI):
         return z[::-1]
 
     def roiUpdate(self):
-        self.calculate()
-        self.redraw()
-
-    def snip(self,data):
-        x = data.copy()
-
-        for p in range(1,self.spectra_plot.snip_m)[::-1]:
-            a1 = x[p:-p]
-            a2 = (x[:(-2 * p)] + x[(2 * p):]) * 0.5
-            x[p:-p] = minimum(a2,a1)
-
-        return x
+        s1,s2 = self.slices()
+        args = (s1,s2,self.data.snapshot(),self.spectra_plot.normalized_roi,self.spectra_plot.snip_m,(self.conv,self.snips))
+        self.main.worker.submit(('roi',id(self)),lambda: self.calculate(*args),self.assign)
 
     def redraw(self):
         self.spectra_plot.clear()
 
         for roi in self.image_plot.roi_list:
 
+            if not hasattr(roi,'snip_z'):
+                continue
+
             if self.main.calibration == True:
 
                 if self.spectra_plot.subtract_snip == True:
@@ -0,0 +1,178 @@
+"""
+Timing and memory of the processing stages.
+
+Every stage is a `with stage(name):` block. What is reported is chosen once
+with configure:
+
+    'progress'  prints the message of the stage when it starts (default)
+    'table'     prints a summary table per stage name at exit
+    'json'      writes a JSON line per finished stage
+    'off'       reports nothing
+
+The peak memory is measured by tracemalloc, which is process-wide: it is
+recorded for the stages of the main thread only and includes what other
+threads allocate meanwhile. The stages of other threads, e.g. the GUI worker,
+record None.
+"""
+from time import perf_counter,process_time
+from contextlib import contextmanager
+from threading import local,current_thread,main_thread
+import tracemalloc
+import atexit
+import json
+import sys
+
+from src.lazy import import_all
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+MODES = ('progress','table','json','off')
+
+mode = 'progress'
+path = None
+output = sys.stderr
+records = []
+
+_stacks = local()
+
+def configure(report = 'progress',name = None):
+    """
+    Select the report, one of MODES, and for json the output file, stderr by default.
+
+    Configuring the current report again does nothing, e.g. once per scan in a worker process.
+    """
+    global mode,path,output
+
+    if report not in MODES:
+        raise ValueError('Unknown report: %s'%report)
+
+    if (report,name) == (mode,path):
+        return
+
+    if output is not sys.stderr:
+        output.close()
+
+    mode = report
+    path = name
+    output = sys.stderr if name is None else open(name,'a')
+
+    if mode in ('table','json') and not tracemalloc.is_tracing():
+        # the lazy imports would be charged to the stage of their first use
+        import_all()
+        tracemalloc.start()
+
+def settings():
+    """
+    Arguments of configure giving the current report, e.g. for worker processes.
+    """
+    return (mode,path)
+
+def max_rss():
+    """
+    Maximum resident size of the process in MB, None where it is not available.
+
+    ru_maxrss is in kB on Linux and in bytes on macOS.
+    """
+    if resource is None:
+        return None
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 2**20 if sys.platform == 'darwin' else rss / 2**10
+
+def _stack():
+    if not hasattr(_stacks,'stack'):
+        _stacks.stack = []
+
+    return _stacks.stack
+
+@contextmanager
+def stage(name,message = None,**info):
+    """
+    Measure the block as the stage `name`.
+
+    Records the wall time, the CPU time of the process, on the main thread
+    the peak of the traced memory above the memory at the start, which
+    includes numpy arrays, and the maximum resident size of the process
+    where the resource module is available.
+    info, which the block gets and may extend, is added to the record.
+    """
+    if mode == 'progress' and message is not None:
+        print(message)
+
+    if mode in ('progress','off'):
+        yield info
+        return
+
+    stack = _stack()
+    traced = current_thread() is main_thread()
+
+    # the peak is reset per stage, the enclosing stages keep the largest one
+    entry = {}
+    if traced:
+        current,peak = tracemalloc.get_traced_memory()
+        if stack:
+            stack[-1]['peak'] = max(stack[-1]['peak'],peak)
+        tracemalloc.reset_peak()
+        entry = {'start':current,'peak':current}
+
+    stack.append(entry)
+    wall,cpu = perf_counter(),process_time()
+
+    try:
+        yield info
+    finally:
+        wall,cpu = perf_counter() - wall,process_time() - cpu
+
+        stack.pop()
+        if traced:
+            current,peak = tracemalloc.get_traced_memory()
+            entry['peak'] = max(entry['peak'],peak)
+            if stack:
+                stack[-1]['peak'] = max(stack[-1]['peak'],entry['peak'])
+            tracemalloc.reset_peak()
+
+        record = {'stage':name,'depth':len(stack),'wall_s':wall,'cpu_s':cpu,
+            'peak_mb':(entry['peak'] - entry['start']) / 2**20 if traced else None,
+            'max_rss_mb':max_rss()}
+        record.update(info)
+
+        records.append(record)
+        if mode == 'json':
+            print(json.dumps(record,default=str),file=output,flush=True)
+
+def note(*args):
+    """
+    print for the progress report, e.g. values found by a stage.
+    """
+    if mode == 'progress':
+        print(*args)
+
+def summary():
+    """
+    Calls, total wall and CPU time and the largest peak memory per stage name.
+    """
+    table = {}
+    for record in records:
+        row = table.setdefault(record['stage'],{'calls':0,'wall_s':0.0,'cpu_s':0.0,'peak_mb':None})
+        row['calls'] += 1
+        row['wall_s'] += record['wall_s']
+        row['cpu_s'] += record['cpu_s']
+        if record['peak_mb'] is not None:
+            row['peak_mb'] = max(row['peak_mb'] or 0.0,record['peak_mb'])
+
+    return table
+
+def print_summary():
+    if mode != 'table' or not records:
+        return
+
+    print('%-20s %8s %10s %10s %10s'%('stage','calls','wall s','cpu s','peak MB'),file=output)
+    for name,row in summary().items():
+        peak = '-' if row['peak_mb'] is None else '%.1f'%row['peak_mb']
+        print('%-20s %8d %10.3f %10.3f %10s'%(name,row['calls'],row['wall_s'],row['cpu_s'],peak),file=output)
+
+atexit.register(print_summary)
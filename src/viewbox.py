@@ -148,7 +148,7 @@ class MyViewBox(ViewBox):
                 w = abs(x[0] - x[1]) + 1
                 h = abs(y[0] - y[1]) + 1
 
-                roi = MyROI([x0,y0],[w,h],translateSnap = True,scaleSnap = True, maxBounds = QtCore.QRectF(0,0,self.main.data.inverted.shape[1],self.main.data.inverted.shape[0]))
+                roi = MyROI([x0,y0],[w,h],translateSnap = True,scaleSnap = True, maxBounds = QtCore.QRectF(0,0,self.main.data.view_shape[1],self.main.data.view_shape[0]))
                 
                 print('new roi:',[x0,y0],[w,h])
 
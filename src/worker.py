@@ -0,0 +1,72 @@
+from pyqtgraph.Qt import QtCore
+
+from threading import Condition
+from traceback import print_exc
+
+class ComputeWorker(QtCore.QThread):
+    """
+    Background thread computing band images and spectra for the viewer.
+
+    Requests are kept per key and a new request replaces a pending one with
+    the same key, so during a drag only the latest region or ROI state is
+    computed. Every result is passed to the callback of its request on the
+    GUI thread.
+    """
+    computed = QtCore.pyqtSignal(object)
+
+    def __init__(self,parent=None):
+        super().__init__(parent)
+
+        self.pending = {}
+        self.condition = Condition()
+        self.running = True
+        self.busy = False
+
+        self.computed.connect(self.deliver)
+        self.start()
+
+    def submit(self,key,fce,callback):
+        """
+        Compute fce() in the background and call callback(result) on the GUI thread.
+        """
+        with self.condition:
+            self.pending.pop(key,None)
+            self.pending[key] = (fce,callback)
+            self.condition.notify()
+
+    def idle(self):
+        with self.condition:
+            return not self.pending and not self.busy
+
+    def run(self):
+        while True:
+            with self.condition:
+                self.busy = False
+                while self.running and not self.pending:
+                    self.condition.wait()
+
+                if not self.running:
+                    return
+
+                key = next(iter(self.pending))
+                fce,callback = self.pending.pop(key)
+                self.busy = True
+
+            try:
+                result = fce()
+            except Exception:
+                print_exc()
+                continue
+
+            self.computed.emit((callback,result))
+
+    def deliver(self,item):
+        callback,result = item
+        callback(result)
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+        self.wait()
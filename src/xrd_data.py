@@ -1,31 +1,400 @@
-from numpy import array,save,load,argmax,swapaxes,loadtxt,arange,pad,roll,minimum,sqrt,expand_dims,log,unravel_index,asarray,frombuffer,arctan,pi
-from matplotlib.pyplot import imshow,plot,figure,show
-from scipy.optimize import curve_fit
-from scipy.interpolate import interp1d
-from scipy.stats import kurtosis
-from numpy import fft,uint8
+from numpy import array,save,load,argmax,swapaxes,loadtxt,arange,pad,roll,minimum,sqrt,expand_dims,log,unravel_index,asarray,frombuffer,arctan,tan,pi
+from numpy import fft,uint8,int64,float64,empty,zeros,cumsum,moveaxis,exp,where,errstate,take_along_axis,floor,clip,stack
+from numpy import float32,uint32,min_scalar_type,result_type,iinfo,subtract,lexsort,unique,add
+from numpy.lib.stride_tricks import sliding_window_view
 
 from glob import glob
+from numpy.lib.format import open_memmap
+from concurrent.futures import ProcessPoolExecutor,ThreadPoolExecutor
+from contextlib import nullcontext
 import re
-import h5py
-from scipy import signal
+import json
+import hashlib
+import os
+from fnmatch import fnmatch
+from collections import deque
+from threading import RLock
+from copy import copy
+
+from src.edf import read_header,parse_header,memmap_edf,edf_body
+from src.archive import is_archive,archive_stem,archive_names,iter_members,read_head,open_member
+from src.stages import stage,note
+from src.lazy import LazyModule
+
+h5py = LazyModule('h5py')
+optimize = LazyModule('scipy.optimize')
+stats = LazyModule('scipy.stats')
+signal = LazyModule('scipy.signal')
+
+def frame_key(name):
+    """
+    Sort key of the source files: all digits of the name as one number.
+    """
+    return int(re.sub('\\D','',name))
+
+def pool(workers,executor):
+    """
+    Worker pool of the given executor class, a context returning None if workers == 1.
+    """
+    if workers == 1:
+        return nullcontext()
+
+    return executor(workers)
+
+def read_frame(name):
+    """
+    Reads the counts (second column) of a single Frame*.dat file.
+    """
+    return loadtxt(name,usecols=1,dtype=int64,ndmin=1)
+
+def read_frames(names,executor=None,narrow=False):
+    """
+    Reads Frame*.dat files into a preallocated (frames,channels) array.
+
+    Parameters
+    ---------
+    names: list
+        a list of file names.
+    executor: Executor
+        pool used to parse the files, None parses them serially.
+    narrow: bool
+        store the counts in the narrowest integer type holding them, widened
+        only when a frame does not fit.
+    """
+    first = read_frame(names[0])
+    source = empty((len(names),len(first)),dtype=narrow_dtype(first) if narrow else first.dtype)
+    source[0] = first
+
+    if executor is None:
+        frames = map(read_frame,names[1:])
+    else:
+        frames = executor.map(read_frame,names[1:],chunksize=64)
+
+    for i,y in enumerate(frames,1):
+        if narrow:
+            dtype = result_type(source.dtype,narrow_dtype(y))
+            if dtype != source.dtype:
+                source = source.astype(dtype)
+
+        source[i] = y
+
+    return source
+
+def parse_frame(content):
+    """
+    Reads the counts (second column) of a Frame*.dat file read as bytes.
+    """
+    return loadtxt(content.decode().splitlines(),usecols=1,dtype=int64,ndmin=1)
+
+def parse_frames(contents):
+    return [parse_frame(content) for content in contents]
+
+def read_archive_frames(path,names,executor=None,narrow=False,batch=64):
+    """
+    Reads Frame*.dat members of an archive into a preallocated (frames,channels) array in the order of names.
+
+    The archive is decompressed in archive order in this thread while batches
+    of members are parsed on the executor, so decompression and parsing
+    overlap. Every frame is placed by its position in names.
+
+    Parameters
+    ---------
+    path: str
+        name of the zip or tar archive.
+    names: list
+        member names in frame order.
+    executor: Executor
+        pool used to parse the members, None parses them serially.
+    narrow: bool
+        as read_frames.
+    batch: int
+        members per parsing task.
+    """
+    rank = {name:i for i,name in enumerate(names)}
+    source = None
+    pending = deque()
+
+    def place(ranks,frames):
+        nonlocal source
+        for i,y in zip(ranks,frames):
+            if source is None:
+                source = empty((len(names),len(y)),dtype=narrow_dtype(y) if narrow else y.dtype)
+            elif narrow:
+                dtype = result_type(source.dtype,narrow_dtype(y))
+                if dtype != source.dtype:
+                    source = source.astype(dtype)
+
+            source[i] = y
+
+    def submit(ranks,contents):
+        if executor is None:
+            place(ranks,parse_frames(contents))
+            return
+
+        pending.append((ranks,executor.submit(parse_frames,contents)))
+        while len(pending) > 16:
+            ranks,future = pending.popleft()
+            place(ranks,future.result())
+
+    ranks,contents = [],[]
+    for name,content in iter_members(path,names):
+        ranks += [rank[name]]
+        contents += [content]
+
+        if len(contents) == batch:
+            submit(ranks,contents)
+            ranks,contents = [],[]
+
+    if contents:
+        submit(ranks,contents)
+
+    for ranks,future in pending:
+        place(ranks,future.result())
+
+    return source
+
+def read_archive_lines(path,names,out=None):
+    """
+    Reads EDF members of an archive into a (lines,pixels,channels) array in reversed line order, as read_lines.
+    """
+    rank = {name:i for i,name in enumerate(names)}
+
+    for name,content in iter_members(path,names):
+        body = edf_body(content)
+        if out is None:
+            out = empty((len(names),) + body.shape,dtype=body.dtype.newbyteorder('='))
+
+        out[len(names) - 1 - rank[name]] = body
+
+    return out
+
+def read_lines(names,executor=None,out=None):
+    """
+    Reads EDF lines into a (lines,pixels,channels) array in reversed line order.
+
+    Parameters
+    ---------
+    names: list
+        a list of file names.
+    executor: Executor
+        pool used to copy the lines, None copies them serially.
+    out: numpy array
+        preallocated output, allocated from the first header if None.
+    """
+    if out is None:
+        header = read_header(names[0])
+        out = empty((len(names),) + header['shape'],dtype=header['dtype'].newbyteorder('='))
+
+    def read_line(i):
+        out[len(names) - 1 - i] = memmap_edf(names[i])
+
+    if executor is None:
+        for i in range(len(names)):
+            read_line(i)
+
+    else:
+        list(executor.map(read_line,range(len(names))))
+
+    return out
+
+def file_digest(name):
+    """
+    SHA-1 of the content of a file.
+    """
+    with open(name,'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def file_manifest(names,executor=None,digests=True):
+    """
+    Name, size, modification time and, with digests, SHA-1 of every source file.
+
+    Parameters
+    ---------
+    names: list
+        a list of file names.
+    executor: Executor
+        pool used to hash the files, None hashes them serially.
+    digests: bool
+        hash the files, the quick check of update_h5 only needs their stat.
+    """
+    stats = [os.stat(name) for name in names]
+    manifest = {'names':[os.path.basename(name) for name in names],
+        'size':array([s.st_size for s in stats],dtype=int64),
+        'mtime':array([s.st_mtime_ns for s in stats],dtype=int64)}
+
+    if digests:
+        manifest['sha1'] = list(map(file_digest,names) if executor is None else executor.map(file_digest,names))
+
+    return manifest
+
+def write_manifest(f,manifest):
+    """
+    Store the manifest as the manifest group of the h5 file f.
+    """
+    if 'manifest' in f:
+        del f['manifest']
+
+    group = f.create_group('manifest')
+    for key in ['names','sha1']:
+        group.create_dataset(key,data=manifest[key],dtype=h5py.string_dtype())
+    for key in ['size','mtime']:
+        group.create_dataset(key,data=manifest[key])
+
+def read_manifest(f):
+    """
+    The manifest stored in the h5 file f.
+    """
+    group = f['manifest']
+    return {'names':list(group['names'].asstr()[()]),'sha1':list(group['sha1'].asstr()[()]),
+        'size':group['size'][()],'mtime':group['mtime'][()]}
+
+def fits(x,dtype):
+    """
+    True if the values of x can be stored as dtype without overflow.
+    """
+    if dtype.kind not in 'biu':
+        return True
+
+    return x.min() >= iinfo(dtype).min and x.max() <= iinfo(dtype).max
+
+def frame_pixels(frames,n,columns):
+    """
+    Map row and column of the sorted frames of n, as read_xrd, reshape and invert place them.
+    """
+    rows,column = divmod(n - 1 - asarray(frames),columns)
+    return rows,where(rows % 2 == 1,columns - 1 - column,column)
+
+def accumulator(x):
+    """
+    Overflow safe dtype for sums of x: int64 for integer and float64 for float data.
+    """
+    return int64 if x.dtype.kind in 'biu' else float64
+
+def index_dtype(x):
+    """
+    dtype of the channel index of x: uint32 if the sum of all channels of a pixel fits, accumulator(x) otherwise.
+    """
+    if x.dtype.kind == 'u' and iinfo(x.dtype).max * x.shape[2] < 2**32:
+        return uint32
+
+    return accumulator(x)
+
+def channel_index(x):
+    """
+    Cumulative sum of a (rows,columns,channels) cube along the channels, channel first.
+
+    index[k] is the sum of the channels [0,k), so any band map is index[right] - index[left].
+    """
+    index = empty((x.shape[2] + 1,) + x.shape[:2],dtype=index_dtype(x))
+    index[0] = 0
+    cumsum(moveaxis(x,2,0),axis=0,out=index[1:])
+
+    return index
+
+def integral_image(x):
+    """
+    Summed-area table of a (rows,columns,channels) cube over the map.
+
+    table[i,j] is the spectrum summed over the pixels [:i,:j], so the spectrum
+    of any rectangle costs four lookups.
+    """
+    table = empty((x.shape[0] + 1,x.shape[1] + 1,x.shape[2]),dtype=accumulator(x))
+    table[0] = 0
+    table[:,0] = 0
+    cumsum(x,axis=0,out=table[1:,1:])
+    cumsum(table[1:,1:],axis=1,out=table[1:,1:])
+
+    return table
+
+def narrow_dtype(x):
+    """
+    Narrowest dtype holding x: the smallest integer type fitting its range, float data keeps its dtype.
+    """
+    if x.dtype.kind in 'biu':
+        return result_type(min_scalar_type(x.min()),min_scalar_type(x.max()))
+
+    return x.dtype
+
+def cube_chunks(shape,chunks=(8,8,128)):
+    """
+    Chunk shape of a (rows,columns,channels) cube: blocks of pixels by a channel range.
+
+    A band map reads one channel range of every block and a pixel spectrum
+    a column of blocks, so neither reads the whole cube.
+    """
+    return tuple(min(c,n) for c,n in zip(chunks,shape))
+
+def write_cube(f,name,x,dtype=None,chunks=None,rows=8,**options):
+    """
+    Write x as the `name` dataset of f in blocks of rows, converted to dtype on the fly.
+    """
+    dataset = f.create_dataset(name,shape=x.shape,dtype=x.dtype if dtype is None else dtype,chunks=chunks,**options)
+    for start in range(0,x.shape[0],rows):
+        dataset[start:start + rows] = x[start:start + rows]
+
+    return dataset
+
+def region_sum(x,rows,columns,block=8):
+    """
+    Spectrum of x summed over x[rows,columns], reading `block` rows at a time.
+
+    x may be an h5py dataset, only the region is read.
+    """
+    r = range(*rows.indices(x.shape[0]))
+    spectra = zeros(x.shape[2],dtype=accumulator(x))
+
+    for i in range(0,len(r),block):
+        part = r[i:i + block]
+        spectra += x[part.start:part[-1] + 1:part.step,columns].sum(axis=(0,1),dtype=spectra.dtype)
+
+    return spectra
+
+def parity_column_sums(x,block=8):
+    """
+    Spectra of x summed over the even and over the odd rows, per column, reading `block` rows at a time.
+    """
+    sums = zeros((2,) + x.shape[1:],dtype=accumulator(x))
+
+    for start in range(0,x.shape[0],2 * block):
+        part = x[start:start + 2 * block]
+        sums[0] += part[0::2].sum(axis=0,dtype=sums.dtype)
+        sums[1] += part[1::2].sum(axis=0,dtype=sums.dtype)
+
+    return sums
+
+def invert_rows(z,first=0):
+    """
+    Invert every second row of a block of map rows starting at row `first`
+    """
+    z = z.copy()
+    z[1 - first % 2::2] = z[1 - first % 2::2,::-1]
+
+    return z
 
 class Calibration():
     """
     Channels Calibration Class.
+
+    The fit is cached in the process per calibration data, so it runs once
+    whatever the number of scans, and is stored in data.h5, whose load_h5
+    adds it to the cache. name may also be an open file, e.g. an archive
+    member.
     """
+    fitted = {}
+
     def __init__(self,name,parent=None,n_channels=1280):
 
+        self.name = name
         self.data = array([[1,2,3,4,5],[1,2,3,4,5]])
         self.n_channels = n_channels
 
         try:
             self.data = loadtxt(name,unpack=True)
-            print('Calibration data:',self.data)
+            note('Calibration data:',self.data)
 
         except:
-            print(name,'is missing.')
-            print('Calibration data:',self.data)
+            note(name,'is missing.')
+            note('Calibration data:',self.data)
 
         self.calibrate(n_channels)
 
@@ -45,34 +414,124 @@ class Calibration():
         """
         return (arctan((x + a) / s)) * 180 / pi + beta
 
+    @staticmethod
+    def ifce_arctan(theta,a,s,beta):
+        """
+        Inverse of the XRD calibration function, channel of 2 theta
+        """
+        return s * tan((theta - beta) * pi / 180) - a
+
+    def fit(self):
+        """
+        Parameters and covariance of fce_arctan fitted to the calibration data, cached by the hash of the data.
+        """
+        key = self.key(self.data)
+        if key in Calibration.fitted:
+            return Calibration.fitted[key]
+
+        with stage('calibration_fit'):
+            x,y = self.data
+            #fit = curve_fit(self.fce_second,x,y)
+            #fit = curve_fit(self.fce_third,x,y)
+            fit = optimize.curve_fit(self.fce_arctan,x,y)
+
+        Calibration.fitted[key] = fit
+        return fit
+
+    @staticmethod
+    def key(data):
+        """
+        Key of the fit of the calibration data in Calibration.fitted.
+        """
+        return 'arctan:' + hashlib.sha1(asarray(data,dtype=float64).tobytes()).hexdigest()
+
     def calibrate(self,n_channels=1280):
         self.n_channels = n_channels
 
-        x,y = self.data
-        #self.opt,self.opt_var = curve_fit(self.fce_second,x,y)
-        #self.opt,self.opt_var = curve_fit(self.fce_third,x,y)
-        self.opt,self.opt_var = curve_fit(self.fce_arctan,x,y)
+        with stage('calibrate',n_channels=n_channels) as info:
+            self.opt,self.opt_var = self.fit()
 
-        print('Calibrated data:',self.opt)
+            note('Calibrated data:',self.opt)
+            info['opt'] = list(self.opt)
 
-        self.c0 = arange(0,n_channels)
-        #self.cx = self.fce_third(self.c0,*self.opt)
-        self.cx = self.fce_arctan(self.c0,*self.opt)
-        self.ic = interp1d(self.cx,self.c0,fill_value='extrapolate')
+            self.c0 = arange(0,n_channels)
+            #self.cx = self.fce_third(self.c0,*self.opt)
+            self.cx = self.fce_arctan(self.c0,*self.opt)
 
     def c(self,x):
         #return self.fce_second(x,*self.opt)
         #return self.fce_third(x,*self.opt)
         return self.fce_arctan(x,*self.opt)
 
+    def ic(self,x):
+        """
+        Channel of 2 theta, the analytic inverse of c.
+        """
+        return self.ifce_arctan(asarray(x,dtype=float64),*self.opt)
+
 class DataXRD():
     """
     Class for processing XRD data.
     """
-    def __init__(self,path = './',parameters = 'Scanning_Parameters.txt',calibration='Calibration.ini'):
+    cubes = ('inverted','convoluted','snipped')
+
+    def __init__(self,path = './',parameters = 'Scanning_Parameters.txt',calibration='Calibration.ini',index=True,counts=None,floats=float32):
+        """
+        counts is the dtype of the raw integer counts, None for the narrowest
+        integer type holding them, float counts keep their dtype. floats is the
+        dtype of the smoothed and background subtracted cubes.
+        """
+        self.lock = RLock()
+        self.versions = {}
+        self.cache = {}
+        self.counts = counts
+        self.floats = floats
+
         self.path = path
         self.parameters = parameters
         self.calibration = calibration
+        self.index = index
+        self.shift_y = 0
+        self.preprocessing = {}
+        self.h5 = None
+        self.archive = is_archive(path)
+
+    def __setattr__(self,name,value):
+        super().__setattr__(name,value)
+
+        if name in self.cubes and 'cache' in self.__dict__:
+            self.invalidate(name)
+
+    def invalidate(self,name):
+        """
+        Drop everything cached for the `name` cube.
+        """
+        with self.lock:
+            self.versions[name] = self.versions.get(name,0) + 1
+            for key in [key for key in self.cache if key[0] == name]:
+                del self.cache[key]
+
+    def snapshot(self):
+        """
+        Shallow copy sharing the cubes and the cache, with its own shift_y.
+
+        The worker computes on a snapshot, so that shift_y changed meanwhile
+        on the GUI thread does not mix two shifts in one image.
+        """
+        return copy(self)
+
+    def count_array(self,x):
+        """
+        x in the counts dtype, float data keeps its dtype.
+        """
+        if x.dtype.kind == 'f':
+            dtype = x.dtype
+        elif self.counts is None:
+            dtype = narrow_dtype(x)
+        else:
+            dtype = self.counts
+
+        return x.astype(dtype,copy=False)
 
     def read_params(self,name=None):
         """
@@ -89,12 +548,12 @@ class DataXRD():
             a dictionary of parameters
         """
         if name == None:
-            name = self.path + '/' + self.parameters
+            name = self.side_file(self.parameters)
 
-        print('Reading parameters from:',name)
+        note('Reading parameters from:',name)
         params = {}
 
-        with open(name,'r') as f:
+        with (open(name,'r') if isinstance(name,str) else name) as f:
             for line in f:
                 try:
                     key,value = line.split('=')
@@ -107,149 +566,680 @@ class DataXRD():
                         params[x.group(1)] = int(n.group(1))
 
         self.params = params
-        print(self.params)
+        note(self.params)
+
+    def source_names(self,pattern):
+        """
+        Source files matching pattern in frame order, the matching members if the data path is an archive.
+        """
+        if self.archive:
+            return sorted([name for name in archive_names(self.path) if fnmatch(os.path.basename(name),pattern)],key=frame_key)
 
-    def read_xrd(self):
-        names = sorted(glob(self.path + '/[F,f]rame*.dat'), key=lambda x: int(re.sub('\D','',x)))
+        return sorted(glob(self.path + '/' + pattern),key=frame_key)
 
-        print("Reading XRD data")
-        self.__read_xrd(names)
-        print("Done")
+    def xrd_names(self):
+        return self.source_names('[F,f]rame*.dat')
 
-    def __read_xrd(self,names):
+    def xrf_names(self):
+        return self.source_names('*Z0*.edf')
+
+    def side_file(self,name):
+        """
+        The side file `name`, e.g. the scanning parameters: in the data folder or,
+        for an archive, its member of that name, opened, or the file next to it.
+        """
+        if not self.archive:
+            return self.path + '/' + name
+
+        members = [member for member in archive_names(self.path) if os.path.basename(member) == name]
+        if members:
+            return open_member(self.path,members[0])
+
+        return os.path.join(os.path.dirname(self.path),name)
+
+    def data_h5(self):
+        """
+        Default h5 file: data.h5 in the data folder, <archive>.h5 next to an archive.
+        """
+        if self.archive:
+            return archive_stem(self.path) + '.h5'
+
+        return self.path + '/' + 'data.h5'
+
+    def read_xrd(self,workers=None):
+        names = self.xrd_names()
+
+        with stage('read_xrd',"Reading XRD data",frames=len(names)):
+            self.__read_xrd(names,workers)
+
+        self.manifest_of(names,workers)
+
+    def __read_xrd(self,names,workers=None):
         """
         Reads the source data.
 
+        The frames are parsed in a process pool and written straight
+        into a preallocated array.
+
         Parameters
         ---------
         names: list
             a list of file names.
+        workers: int
+            number of worker processes, None uses all cores and 1 reads serially.
 
         Returns
         -------
         numpy array
-            3 dimmensional array x,y,spectra
+            2 dimmensional array frames,spectra
         """
-        z = []
-        for file in names:
+        with pool(workers,ProcessPoolExecutor) as executor:
+            if self.archive:
+                source = read_archive_frames(self.path,names,executor,self.counts is None)
+            else:
+                source = read_frames(names,executor,self.counts is None)
 
-            y = []
-            with open(file,mode='r') as f:
-                for line in f:
-                    x = line.split()[1]
-                    y += [int(x)]
+            self.source = self.count_array(source)[::-1]
 
-            z += [array(y)]
+    def read_xrf(self,workers=None,mmap=None):
 
-        self.source = array(z)[::-1]
+        names = self.xrf_names()
 
-    def read_xrf(self):
+        with stage('read_xrf',"Reading XRF data",lines=len(names)):
+            self.__read_xrf(names,workers,mmap)
 
-        names = sorted(glob(self.path + '/*Z0*.edf'), key=lambda x: int(re.sub('\D','',x)))
+        self.manifest_of(names,workers)
 
-        print("Reading XRF data")
-        self.__read_xrf(names)
-        print("Done")
+    def manifest_of(self,names,workers=None):
+        """
+        Keep the manifest of the source files, written to data.h5 by save_h5 and stream_h5.
 
-    def __read_xrf(self,names,n=14,shape=(-1,2048)):
+        Archives have none, their h5 file is rebuilt.
+        """
+        if self.archive:
+            return
 
-        def read_edf_line(name,n,shape=(-1,2048)):
-            with open(name,'rb') as f:
-                for _ in range(n):
-                    f.readline()
+        with stage('manifest',files=len(names)),pool(workers,ThreadPoolExecutor) as executor:
+            self.manifest = file_manifest(names,executor)
 
-                x = frombuffer(f.read(),'d')
-                x = x.reshape(*shape)
+    def __read_xrf(self,names,workers=None,mmap=None):
+        """
+        Reads the EDF lines into a single array.
 
-            return x
+        Every line is memory-mapped using its own header and copied once
+        into the preallocated cube in reversed line order. Integer counts are
+        copied in the counts dtype, or kept in the EDF dtype when counts is
+        None, so the cube is never narrowed by a second, full copy; the
+        chunked layout of save_h5 narrows them when writing.
 
-        x = []
-        for name in names:
-            x += [read_edf_line(name,n,shape)]
+        Parameters
+        ---------
+        names: list
+            a list of file names.
+        workers: int
+            number of copying threads, None uses all cores and 1 reads serially.
+        mmap: str
+            if set, the cube is a .npy memory-mapped file of this name instead of an in-memory array.
+        """
+        header = parse_header(read_head(self.path,names[0])) if self.archive else read_header(names[0])
+        shape = (len(names),) + header['shape']
+        dtype = header['dtype'].newbyteorder('=')
+        if dtype.kind in 'biu' and self.counts is not None:
+            dtype = self.counts
+
+        if mmap is None:
+            x = empty(shape,dtype=dtype)
+        else:
+            x = open_memmap(mmap,mode='w+',dtype=dtype,shape=shape)
 
-        self.inverted = asarray(x)[::-1]
+        if self.archive:
+            read_archive_lines(self.path,names,x)
+        else:
+            with pool(workers,ThreadPoolExecutor) as executor:
+                read_lines(names,executor,x)
+
+        self.inverted = x
         self.shape = self.inverted.shape
 
     def calibrate(self,n_channels=1280):
-        self.calibration = Calibration(self.path + '/' + self.calibration,self,n_channels)
+        self.calibration = Calibration(self.side_file(self.calibration),self,n_channels)
 
     def reshape(self):
-        self.reshaped = self.source.reshape(self.params['y'],self.params['x'],-1)
-        self.shape = self.reshaped.shape
+        with stage('reshape'):
+            self.reshaped = self.source.reshape(self.params['y'],self.params['x'],-1)
+            self.shape = self.reshaped.shape
 
     def invert(self):
-        def invert(z):
-            """
-            Invert every second row
-            """
-            s = 1
-            x = []
-            for v in z:
-                if s == 1:
-                    x += [v]
-                else:
-                    x += [v[::-1]]
-                s *= -1
-
-            return array(x)
+        with stage('invert'):
+            self.inverted = invert_rows(self.reshaped)
 
-        self.inverted = invert(self.reshaped)
-
-    def from_source(self):
+    def from_source(self,workers=None,tile=8):
         """
         Read data from source
+
+        workers sets the number of reader and smoothing workers and tile the
+        number of map rows smoothed at once.
         """
-        if glob(self.path + '/F*.dat'):
+        if self.source_names('F*.dat'):
             self.read_params()
-            self.read_xrd()
+            self.read_xrd(workers)
 
             self.reshape()
             self.invert()
 
         else:
-            self.read_xrf()
+            self.read_xrf(workers)
 
-        print('Smoothing data')
-        self.convoluted = Preprocessing.convolve(self.inverted)
+        self.convoluted = self.smooth(self.inverted,workers,tile)
 
         return self
 
+    def smooth(self,x,workers=None,tile=8,off=48):
+        """
+        Preprocessing.convolve of x, recording its parameters for save_h5.
+        """
+        self.preprocessing['convolve'] = {'off':off}
+
+        with stage('convolve','Smoothing data',shape=x.shape):
+            return Preprocessing.convolve(x,off,workers,tile,self.floats)
+
+    def stream_h5(self,name=None,rows=8,workers=None,tile=8):
+        """
+        Read data from source and write data.h5 block by block.
+
+        Only `rows` map rows are read, inverted and smoothed at a time and
+        appended to the resizable inverted and convoluted datasets, so the
+        peak memory depends on the block size and not on the scan size.
+
+        Parameters
+        ---------
+        name: str
+            name of the h5 file, data.h5 in the data folder by default.
+        rows: int
+            number of map rows per block.
+        workers: int
+            number of reader and smoothing workers, None uses all cores and 1 works serially.
+        tile: int
+            number of map rows smoothed at once.
+        """
+        if name == None:
+            name = self.data_h5()
+
+        if self.archive:
+            raise ValueError('%s is an archive, stream_h5 reads extracted scans'%self.path)
+
+        if self.source_names('F*.dat'):
+            self.read_params()
+            names = self.xrd_names()
+            n_rows,n_columns = self.params['y'],self.params['x']
+
+            if len(names) != n_rows * n_columns:
+                raise ValueError('%d frames do not match a %d x %d scan'%(len(names),n_rows,n_columns))
+
+            def read_block(start,stop,executor):
+                block = read_frames(names[len(names) - stop * n_columns:len(names) - start * n_columns],executor)[::-1]
+                return invert_rows(block.reshape(stop - start,n_columns,-1),start)
+
+            readers = pool(workers,ProcessPoolExecutor)
+
+        else:
+            names = self.xrf_names()
+            n_rows = len(names)
+
+            def read_block(start,stop,executor):
+                return read_lines(names[len(names) - stop:len(names) - start],executor)
+
+            readers = pool(workers,ThreadPoolExecutor)
+
+        self.manifest_of(names,workers)
+
+        with stage('stream_h5','Streaming: %s'%name),readers as executor,h5py.File(name,'w') as f:
+            for start in range(0,n_rows,rows):
+                stop = min(start + rows,n_rows)
+
+                with stage('read_block','Rows %d-%d of %d'%(start,stop,n_rows),rows=stop - start):
+                    block = read_block(start,stop,executor)
+
+                convoluted = self.smooth(block,workers,tile)
+
+                if self.index:
+                    index = channel_index(block)
+
+                if start == 0:
+                    inverted_set = f.create_dataset('inverted',shape=(0,) + block.shape[1:],maxshape=(None,) + block.shape[1:],chunks=(1,) + block.shape[1:],dtype=block.dtype if self.counts is None else self.counts)
+                    convoluted_set = f.create_dataset('convoluted',shape=(0,) + block.shape[1:],maxshape=(None,) + block.shape[1:],chunks=(1,) + block.shape[1:],dtype=convoluted.dtype)
+
+                    if self.index:
+                        index_set = f.create_dataset('index_inverted',shape=(index.shape[0],n_rows,index.shape[2]),chunks=(1,min(rows,n_rows),index.shape[2]),dtype=index.dtype)
+
+                for dataset,x in [(inverted_set,block),(convoluted_set,convoluted)]:
+                    dataset.resize(stop,axis=0)
+                    dataset[start:stop] = x
+
+                if self.index:
+                    index_set[:,start:stop] = index
+
+            self.shape = inverted_set.shape
+            f.attrs.update(self.metadata())
+            if hasattr(self,'manifest'):
+                write_manifest(f,self.manifest)
+
+        return self
+
+    def update_h5(self,name=None,workers=None,tile=8,layout=None,compression='gzip'):
+        """
+        Bring data.h5 up to date with the source files, parsing only the changed ones.
+
+        The files whose size or modification time differ from the manifest are
+        hashed, and those whose content changed are parsed. Their pixels are
+        patched in the stored cubes and in the per pixel products: the
+        convoluted and snipped cubes, the channel indexes and the integrated
+        map. The column sums are dropped and rebuilt on first use.
+
+        Parameters
+        ---------
+        name: str
+            name of the h5 file, data.h5 in the data folder by default.
+        workers: int
+            number of reader workers, None uses all cores and 1 reads serially.
+        tile: int
+            number of map rows smoothed at once.
+        layout: str
+            layout requested for data.h5, see save_h5, None accepts the stored one.
+        compression: str
+            compression requested for the chunked layout.
+
+        Returns
+        -------
+        bool
+            True if data.h5 is up to date, False if it has to be rebuilt: it is
+            missing, has no manifest, its scan shape, channels or count dtype do
+            not fit the source files, its cubes were aligned, or its layout or
+            dtypes are not the requested ones.
+        """
+        if name == None:
+            name = self.data_h5()
+
+        if not os.path.exists(name):
+            return False
+
+        xrd = bool(self.source_names('F*.dat'))
+        names = self.xrd_names() if xrd else self.xrf_names()
+
+        with stage('update_h5','Updating: %s'%name) as info,h5py.File(name,'r+') as f:
+            preprocessing = json.loads(f.attrs.get('preprocessing','{}'))
+            if 'manifest' not in f or 'align' in preprocessing:
+                note('data.h5 cannot be updated, rebuilding')
+                return False
+
+            # the chunked layout narrows the counts whatever the counts dtype
+            stored = f['inverted'].compression
+            if (layout is not None and stored != (compression if layout == 'chunked' else None)
+                or f['convoluted'].dtype != self.floats
+                or stored is None and self.counts is not None and f['inverted'].dtype.kind in 'biu' and f['inverted'].dtype != self.counts):
+                note('%s has another layout or dtype, rebuilding'%name)
+                return False
+
+            manifest = read_manifest(f)
+            n_rows,n_columns,n_channels = f['inverted'].shape
+
+            if xrd:
+                self.read_params()
+                shape = (self.params['y'],self.params['x'])
+            else:
+                shape = (len(names),n_columns)
+
+            if len(names) != len(manifest['names']) or shape != (n_rows,n_columns):
+                note('Source files do not match %s, rebuilding'%name)
+                return False
+
+            current = file_manifest(names,digests=False)
+            suspect = [i for i in range(len(names)) if current['names'][i] != manifest['names'][i]
+                or current['size'][i] != manifest['size'][i] or current['mtime'][i] != manifest['mtime'][i]]
+
+            with pool(workers,ThreadPoolExecutor) as executor:
+                digests = file_manifest([names[i] for i in suspect],executor)['sha1']
+            changed = [i for i,digest in zip(suspect,digests) if digest != manifest['sha1'][i]]
+
+            info.update(suspect=len(suspect),changed=len(changed))
+            note('%d of %d source files changed'%(len(changed),len(names)))
+
+            if changed:
+                if xrd:
+                    rows,columns = frame_pixels(changed,len(names),n_columns)
+                    with pool(workers,ProcessPoolExecutor) as executor:
+                        spectra = read_frames([names[i] for i in changed],executor)
+                else:
+                    rows = (len(names) - 1 - array(changed)).repeat(n_columns)
+                    columns = arange(n_columns * len(changed)) % n_columns
+                    spectra = stack([memmap_edf(names[i]) for i in changed]).reshape(-1,n_channels)
+
+                fit = fits(spectra,f['inverted'].dtype) and ('index_inverted' not in f or fits(spectra.sum(axis=1),f['index_inverted'].dtype))
+                if spectra.shape[1] != n_channels or not fit:
+                    note('Changed source files do not fit %s, rebuilding'%name)
+                    return False
+
+                off = preprocessing.get('convolve',{}).get('off',48)
+                self.patch_h5(f,rows,columns,spectra,off,workers,tile)
+
+            for key in ['names','size','mtime']:
+                for i in suspect:
+                    manifest[key][i] = current[key][i]
+            for i,digest in zip(suspect,digests):
+                manifest['sha1'][i] = digest
+
+            write_manifest(f,manifest)
+
+        return True
+
+    def patch_h5(self,f,rows,columns,spectra,off=48,workers=None,tile=8):
+        """
+        Write the spectra of the pixels (rows,columns) and what is derived from them per pixel into the open h5 file f.
+        """
+        with stage('patch_h5','Patching %d pixels'%len(spectra),pixels=len(spectra)):
+            cubes = {'inverted':spectra,'convoluted':Preprocessing.convolve(spectra[None],off,workers,tile,f['convoluted'].dtype)[0]}
+
+            if 'snipped' in f:
+                snip_m = f['snipped'].attrs.get('snip_m')
+                if snip_m is None:
+                    for key in ['snipped','index_snipped']:
+                        if key in f:
+                            del f[key]
+                else:
+                    snip = Preprocessing.snip(cubes['convoluted'][None],snip_m,workers,tile)[0]
+                    cubes['snipped'] = subtract(spectra,snip,out=empty(spectra.shape,dtype=f['snipped'].dtype))
+                    cubes['snipped'][cubes['snipped'] < 0] = 0
+
+            order = lexsort((columns,rows))
+            rows,columns = asarray(rows)[order],asarray(columns)[order]
+            pixels = [(row,rows == row) for row in unique(rows)]
+
+            for key,x in cubes.items():
+                x = x[order]
+                index = channel_index(x[None])[:,0] if 'index_' + key in f else None
+
+                for row,selected in pixels:
+                    f[key][row,list(columns[selected])] = x[selected]
+                    if index is not None:
+                        f['index_' + key][:,row,list(columns[selected])] = index[:,selected]
+
+                if 'columns_' + key in f:
+                    del f['columns_' + key]
+
+            if 'integrated_inverted' in f:
+                integrated = spectra[order].sum(axis=1)
+                for row,selected in pixels:
+                    f['integrated_inverted'][row,list(columns[selected])] = integrated[selected]
+
+    def stored(self,name):
+        """
+        True if the `name` cube is a dataset of the lazily opened h5 file.
+        """
+        return self.h5 is not None and isinstance(getattr(self,name,None),h5py.Dataset)
+
+    def h5_options(self):
+        """
+        Compression of the inverted dataset, reused for the products stored next to it.
+        """
+        x = self.h5['inverted']
+        if x.compression is None:
+            return {}
+
+        return {'compression':x.compression,'compression_opts':x.compression_opts,'shuffle':x.shuffle}
+
+    def h5_array(self,key,fce):
+        """
+        The `key` array of the open h5 file, stored as fce() if missing.
+        """
+        if key in self.h5:
+            return self.h5[key][()]
+
+        x = fce()
+        if self.h5.mode != 'r':
+            self.h5.create_dataset(key,data=x)
+
+        return x
+
+    def h5_cube(self,key,shape,dtype,block,axis=0,rows=8):
+        """
+        The `key` dataset of the open h5 file, written from block(start,stop) if missing.
+
+        block returns the map rows [start,stop) of the dataset, whose map rows
+        run along `axis`. A read-only file gets an in-memory array instead.
+        """
+        if key in self.h5:
+            return self.h5[key]
+
+        with stage('h5_' + key,'Writing: %s'%key,shape=shape):
+            if self.h5.mode == 'r':
+                out = empty(shape,dtype=dtype)
+            else:
+                chunks = cube_chunks(shape) if axis == 0 else (1,) + shape[1:]
+                out = self.h5.create_dataset(key,shape=shape,dtype=dtype,chunks=chunks,**self.h5_options())
+
+            n = shape[axis]
+            for start in range(0,n,rows):
+                stop = min(start + rows,n)
+                out[(slice(None),) * axis + (slice(start,stop),)] = block(start,stop)
+
+        return out
+
+    def column_sums(self,name='inverted'):
+        """
+        Spectra of the `name` cube summed over the even and over the odd map rows, per column.
+        """
+        def sums(x):
+            if self.stored(name):
+                return self.h5_array('columns_' + name,lambda: parity_column_sums(x))
+            return parity_column_sums(x)
+
+        return self.cached(name,'columns',sums)
+
+    def cached(self,name,kind,fce):
+        """
+        fce applied to the `name` cube, computed once until the cube is reassigned.
+
+        fce runs outside the lock, its result is not kept when the cube was
+        reassigned meanwhile on another thread.
+        """
+        key = (name,kind)
+        with self.lock:
+            if key in self.cache:
+                return self.cache[key]
+            version = self.versions.get(name,0)
+
+        value = fce(getattr(self,name))
+
+        with self.lock:
+            if self.versions.get(name,0) != version:
+                return value
+            return self.cache.setdefault(key,value)
+
+    @property
+    def view_shape(self):
+        """
+        Shape of the cubes seen through the y-shift.
+        """
+        rows,columns,channels = self.inverted.shape
+        return (rows,columns + abs(self.shift_y),channels)
+
+    def offsets(self):
+        """
+        Column offset of the even and odd map rows for the y-shift.
+        """
+        return (max(-self.shift_y,0),max(self.shift_y,0))
+
+    def view_columns(self):
+        """
+        Source column of every pixel of the y-shifted map.
+
+        Every second row is moved by shift_y columns and the map is padded with
+        its edge columns, as Preprocessing.shift_y does.
+        """
+        rows,columns,_ = self.view_shape
+        offset = zeros(rows,dtype=int64)
+        offset[0::2],offset[1::2] = self.offsets()
+
+        return clip(arange(columns) - expand_dims(offset,1),0,self.inverted.shape[1] - 1)
+
+    def view_image(self,image):
+        """
+        Map image seen through the y-shift.
+        """
+        if self.shift_y == 0:
+            return image
+
+        return image[expand_dims(arange(image.shape[0]),1),self.view_columns()]
+
+    def view_block(self,name,start,stop):
+        """
+        Map rows [start,stop) of the `name` cube seen through the y-shift, reading only these rows.
+        """
+        x = getattr(self,name)[start:stop]
+        if self.shift_y == 0:
+            return x
+
+        return x[expand_dims(arange(x.shape[0]),1),self.view_columns()[start:stop]]
+
+    def view(self,name='inverted'):
+        """
+        Copy of the `name` cube with the y-shift applied, e.g. for exports.
+        """
+        return self.view_image(getattr(self,name))
+
+    @property
+    def sum_spectra(self):
+        return self.cached('inverted',('sum_spectra',self.shift_y),lambda x: self.roi_spectra('inverted',slice(None),slice(None)))
+
     @property
     def avg_spectra(self):
-        #if hasattr(self,'__all_spectra'):
-        #    return self.__all_spectra
-        #else:
-        #    self.__all_spectra = self.inverted.sum(axis = 0).sum(axis = 0) / (self.shape[0] * self.shape[1])
-        #    return self.__all_spectra
-        return self.inverted.sum(axis = 0).sum(axis = 0) / (self.shape[0] * self.shape[1])
+        return self.sum_spectra / (self.view_shape[0] * self.view_shape[1])
 
     @property
     def spectra255(self):
-        #if hasattr(self,'__all_spectra'):
-        #    return self.__all_spectra
-        #else:
-        #    self.__all_spectra = self.inverted.sum(axis = 0).sum(axis = 0) / (self.shape[0] * self.shape[1])
-        #    return self.__all_spectra
-        spectra =  self.inverted.sum(axis = 0).sum(axis = 0)
-        return (spectra / spectra.max() * 255).astype(uint8)
+        def spectra255(x):
+            spectra = self.sum_spectra
+            return (spectra / spectra.max() * 255).astype(uint8)
+
+        return self.cached('inverted',('spectra255',self.shift_y),spectra255)
 
     @property
     def integrated_spectra(self):
-        return self.inverted.sum(axis = 2)
+        def integrated_spectra(x):
+            if ('inverted','index') in self.cache or (self.index and self.stored('inverted')):
+                return self.view_image(self.band_index('inverted')[-1])
+            if self.stored('inverted'):
+                return self.view_image(self.h5_cube('integrated_inverted',x.shape[:2],accumulator(x),lambda a,b: x[a:b].sum(axis = 2))[()])
+            return self.view_image(x.sum(axis = 2))
+
+        return self.cached('inverted',('integrated_spectra',self.shift_y),integrated_spectra)
 
     @property
     def normalized_spectra(self):
-        spectra = self.integrated_spectra
-        return (spectra / spectra.max() * 255).astype(uint8)
+        def normalized_spectra(x):
+            spectra = self.integrated_spectra
+            return (spectra / spectra.max() * 255).astype(uint8)
 
-    def crop_spectra(self,left,right):
+        return self.cached('inverted',('normalized_spectra',self.shift_y),normalized_spectra)
+
+    def background(self,snip_m,lls = False,workers = None,tile = 8):
+        """
+        SNIP background of the convoluted cube, cached per snip_m.
+        """
+        return self.cached('convoluted',('snip',snip_m,lls),lambda x: Preprocessing.snip(x,snip_m,workers,tile,lls,self.floats))
+
+    def band_index(self,name='inverted'):
+        """
+        Cumulative channel index of the `name` cube, built on first use.
+
+        The index of a stored cube is written to the h5 file map rows by map rows.
+        """
+        def index(x):
+            if self.stored(name):
+                return self.h5_cube('index_' + name,(x.shape[2] + 1,) + x.shape[:2],accumulator(x),lambda a,b: channel_index(x[a:b]),axis=1)
+            return channel_index(x)
+
+        return self.cached(name,'index',index)
+
+    def band(self,name,left,right):
         """
-        FIXME set bounds maybe.
+        Sum of the `name` cube over the channels [left,right) seen through the y-shift.
+
+        With the index enabled this costs two plane reads whatever the band width.
+        """
+        x = getattr(self,name)
+        left,right,_ = slice(int(left),int(right)).indices(x.shape[2])
+        right = max(left,right)
+
+        if self.index:
+            index = self.band_index(name)
+            return self.view_image(index[right] - index[left])
+
+        return self.view_image(x[:,:,left:right].sum(axis=2))
+
+    def roi_table(self,name='inverted'):
+        """
+        Summed-area tables of the even and odd map rows of the `name` cube, built on first use.
+        """
+        return self.cached(name,'integral',lambda x: (integral_image(x[0::2]),integral_image(x[1::2])))
+
+    def roi_spectra(self,name,rows,columns):
+        """
+        Spectrum of the `name` cube summed over the pixels [rows,columns] of the y-shifted map.
+
+        The even and odd rows are summed separately, each as a rectangle of
+        source columns plus the repeated edge columns. With the index enabled
+        this costs a few spectrum lookups whatever the ROI size.
+
+        Parameters
+        ---------
+        name: str
+            name of the cube, e.g. inverted or convoluted
+        rows,columns: slice
+            ROI slices along the map axes of the y-shifted map.
         """
-        left,right = int(left),int(right)
+        x = getattr(self,name)
+        n_rows,n_columns,_ = self.view_shape
+        r0,r1,_ = rows.indices(n_rows)
+        c0,c1,_ = columns.indices(n_columns)
+        r1,c1 = max(r0,r1),max(c0,c1)
 
-        crop = self.inverted[:,:,left:right]
-        crop = crop.sum(axis=2)
+        if self.index and not self.stored(name):
+            tables = self.roi_table(name)
+
+            def rect(parity,k0,k1,j0,j1):
+                table = tables[parity]
+                return table[k1,j1] - table[k0,j1] - table[k1,j0] + table[k0,j0]
+
+        else:
+            # a stored cube is read only over the ROI, full height columns come from the column sums
+            def rect(parity,k0,k1,j0,j1):
+                if self.stored(name) and k0 == 0 and k1 == (n_rows - parity + 1) // 2:
+                    return self.column_sums(name)[parity,j0:j1].sum(axis=0)
+                return region_sum(x,slice(parity + 2 * k0,parity + 2 * k1,2),slice(j0,j1))
+
+        spectra = zeros(x.shape[2],dtype=accumulator(x))
+        edge = x.shape[1]
+
+        # rows of each parity as indices into x[0::2] and x[1::2]
+        parities = [((r0 + 1) // 2,(r1 + 1) // 2),(r0 // 2,r1 // 2)]
+
+        for parity,((k0,k1),offset) in enumerate(zip(parities,self.offsets())):
+            a,b = c0 - offset,c1 - offset
+            if k0 >= k1 or a >= b:
+                continue
+
+            for j0,j1,weight in [(max(a,0),min(b,edge),1),(0,1,min(b,0) - a),(edge - 1,edge,b - max(a,edge))]:
+                if j0 < j1 and weight > 0:
+                    spectra += weight * rect(parity,k0,k1,j0,j1)
+
+        return spectra
+
+    def crop_spectra(self,left,right):
+        """
+        Band image of the channels [left,right) scaled to 0-255.
+        """
+        crop = self.band('inverted',left,right)
 
         if crop.max() == 0:
             return crop
@@ -258,135 +1248,368 @@ class DataXRD():
 
     def crop_snip_spectra(self,left,right):
         """
-        FIXME set bounds maybe.
+        Band image of the background subtracted channels [left,right) scaled to 0-255.
         """
-        left,right = int(left),int(right)
-        crop = self.snipped[:,:,left:right]
-
-        crop = crop.sum(axis=2)
+        crop = self.band('snipped',left,right)
 
         if crop.max() == 0:
             return crop
         else:
             return (crop / crop.max() * 255).astype(uint8)
 
-    def save_h5(self,name = None):
+    def metadata(self):
+        """
+        Scan parameters, calibration fit and preprocessing parameters as h5 attributes.
+        """
+        attrs = {'preprocessing':json.dumps(self.preprocessing)}
 
+        if hasattr(self,'params'):
+            attrs['params'] = json.dumps(self.params)
+
+        calibration = self.calibration
+        if not isinstance(calibration,Calibration):
+            calibration = Calibration(self.side_file(calibration),self,self.shape[-1] if hasattr(self,'shape') else 1280)
+
+        attrs['calibration_data'] = calibration.data
+        attrs['calibration_opt'] = calibration.opt
+        attrs['calibration_opt_var'] = calibration.opt_var
+
+        return attrs
+
+    def save_h5(self,name = None,layout = 'contiguous',compression = 'gzip'):
+        """
+        Save the inverted and convoluted cubes, the band index and the metadata.
+
+        Parameters
+        ---------
+        name: str
+            name of the h5 file, data.h5 in the data folder by default.
+        layout: str
+            'contiguous' writes the counts as they are. 'chunked' writes them in
+            the narrowest dtype, compressed in blocks of cube_chunks, which
+            serve band maps and pixel spectra alike. Float cubes are written
+            in their dtype.
+        compression: str
+            'gzip' or 'lzf', the filter of the chunked layout.
+        """
         if name == None:
-            name = self.path + '/' + 'data.h5'
+            name = self.data_h5()
+
+        if layout == 'chunked':
+            options = {'compression':compression,'shuffle':True}
+        elif layout == 'contiguous':
+            options = {}
+        else:
+            raise ValueError('Unknown h5 layout: %s'%layout)
+
+        def dtype(x):
+            return narrow_dtype(x) if options else x.dtype
+
+        with stage('save_h5','Saving: %s'%name,layout=layout),h5py.File(name,'w') as f:
+            for key in ['inverted','convoluted']:
+                x = getattr(self,key)
+                write_cube(f,key,x,dtype(x),cube_chunks(x.shape) if options else None,**options)
 
-        print('Saving:',name)
-        with h5py.File(name,'w') as f:
-            f.create_dataset('inverted',data = self.inverted)
-            f.create_dataset('convoluted',data = self.convoluted)
+            if self.index:
+                index = self.band_index()
+                write_cube(f,'index_inverted',index,dtype(index),(1,) + index.shape[1:],**options)
+
+            f.attrs.update(self.metadata())
+
+            if hasattr(self,'manifest'):
+                write_manifest(f,self.manifest)
 
         return self
 
-    def load_h5(self,name = None):
+    def load_h5(self,name = None,workers = None,tile = 8,lazy = False):
+        """
+        Load data.h5.
 
+        With lazy the file is kept open and its datasets are the cubes, so band
+        images, ROI spectra and aggregates read only the slices they need. What
+        is derived from the cubes is stored in the file for the next start; the
+        file is opened for writing if possible.
+        """
         if name == None:
-            name = self.path + '/' + 'data.h5'
+            name = self.data_h5()
+
+        with stage('load_h5',('Opening: %s' if lazy else 'Loading: %s')%name,lazy=lazy):
+            if lazy:
+                try:
+                    f = h5py.File(name,'r+')
+                except OSError:
+                    f = h5py.File(name,'r')
+            else:
+                f = h5py.File(name,'r')
+
+            self.preprocessing = json.loads(f.attrs.get('preprocessing','{}'))
+            if 'params' in f.attrs:
+                self.params = json.loads(f.attrs['params'])
+            if 'calibration_opt_var' in f.attrs:
+                key = Calibration.key(f.attrs['calibration_data'])
+                Calibration.fitted.setdefault(key,(array(f.attrs['calibration_opt']),array(f.attrs['calibration_opt_var'])))
 
-        print('Loading:',name)
+            if lazy:
+                self.h5 = f
+                self.inverted = f['inverted']
+                self.shape = self.inverted.shape
 
-        with h5py.File(name,'r') as f:
+                if 'convoluted' not in f:
+                    note('Preprocess convoluted')
 
-            print('Load inverted')
-            x = f['inverted']
-            self.inverted = x[:]
-            self.shape = self.inverted.shape
+                self.convoluted = self.h5_cube('convoluted',self.shape,self.floats,lambda a,b: self.smooth(self.inverted[a:b],workers,tile))
 
-            if 'convoluted' in f:
-                print('Load convoluted')
-                x = f['convoluted']
-                self.convoluted = x[:]
+                return self
+
+            with f:
+
+                with stage('load_inverted','Load inverted'):
+                    x = f['inverted']
+                    self.inverted = self.count_array(x[:])
+                    self.shape = self.inverted.shape
+
+                if self.index and 'index_inverted' in f:
+                    with stage('load_index','Load index'):
+                        self.cache['inverted','index'] = f['index_inverted'][:]
+
+                if 'convoluted' in f:
+                    with stage('load_convoluted','Load convoluted'):
+                        x = f['convoluted']
+                        self.convoluted = x[:].astype(self.floats,copy=False)
+                else:
+                    note('Preprocess convoluted')
+                    self.convoluted = self.smooth(self.inverted,workers,tile)
+
+        return self
+
+    def subtract_background(self,snip_m = 24,workers = None,tile = 8):
+        """
+        Set snipped to inverted minus the SNIP background of convoluted, clipped at zero.
+
+        With the cubes stored in the open h5 file, snipped is written to it map
+        rows by map rows on the first start and read lazily afterwards.
+        """
+        def difference(inverted,snip):
+            snipped = subtract(inverted,snip,out=empty(inverted.shape,dtype=self.floats))
+            snipped[snipped < 0] = 0
+            return snipped
+
+        self.preprocessing['snip'] = {'snip_m':snip_m}
+
+        if not (self.stored('inverted') and self.stored('convoluted')):
+            with stage('snip','Subtracting background',snip_m=snip_m):
+                self.snip = self.background(snip_m,workers=workers,tile=tile)
+                self.snipped = difference(self.inverted,self.snip)
+
+            return self
+
+        if 'snipped' in self.h5 and self.h5['snipped'].attrs.get('snip_m') != snip_m:
+            if self.h5.mode == 'r':
+                note('Stored snipped cube of another snip_m is used, the file is read-only')
             else:
-                print('Preprocess convoluted')
-                self.convoluted = Preprocessing.convolve(self.inverted)
+                for key in ['snipped','index_snipped','columns_snipped']:
+                    if key in self.h5:
+                        del self.h5[key]
+
+        def block(start,stop):
+            return difference(self.inverted[start:stop],Preprocessing.snip(self.convoluted[start:stop],snip_m,workers,tile))
+
+        self.snipped = self.h5_cube('snipped',self.shape,self.floats,block)
+        if self.h5.mode != 'r' and 'snip_m' not in self.snipped.attrs:
+            self.snipped.attrs['snip_m'] = snip_m
 
         return self
 
-    def shift_z(self,channel = 555):
+    def patch(self,rows,columns,spectra,workers = None,tile = 8):
+        """
+        Write the spectra of the pixels (rows,columns) into the cubes in memory.
 
-        off = 24 
-        win = signal.windows.gaussian(off*2,sqrt(8.1))
+        Only these pixels are smoothed and, after subtract_background, background
+        subtracted. The cached channel indexes, the SNIP background and the sum
+        spectra are patched, so a live update costs the new pixels only.
+        Everything else cached for the cubes is dropped, e.g. the summed-area
+        tables, which the ROI spectra rebuild on the worker.
+        """
+        off = self.preprocessing.get('convolve',{}).get('off',48)
+        cubes = {'inverted':spectra,'convoluted':Preprocessing.convolve(spectra[None],off,workers,tile,self.floats)[0]}
+
+        if hasattr(self,'snipped'):
+            snip = Preprocessing.snip(cubes['convoluted'][None],self.preprocessing['snip']['snip_m'],workers,tile,dtype=self.floats)[0]
+            self.snip[rows,columns] = snip
+
+            cubes['snipped'] = subtract(spectra,snip,out=empty(spectra.shape,dtype=self.floats))
+            cubes['snipped'][cubes['snipped'] < 0] = 0
+
+        for name,x in cubes.items():
+            delta = x.astype(accumulator(x)) - getattr(self,name)[rows,columns]
+            getattr(self,name)[rows,columns] = x
+
+            with self.lock:
+                self.versions[name] = self.versions.get(name,0) + 1
+                for key in [key for key in self.cache if key[0] == name]:
+                    if key[1] == 'index':
+                        self.cache[key][:,rows,columns] = channel_index(x[None])[:,0]
+                    elif key[1][0] == 'sum_spectra':
+                        self.cache[key] = self.cache[key] + (delta * self.view_counts(key[1][1])[rows,columns,None]).sum(axis=0)
+                    elif self.cache[key] is not getattr(self,'snip',None):
+                        del self.cache[key]
+
+    def view_counts(self,shift):
+        """
+        Number of times every pixel of the cubes is seen in the map through the y-shift `shift`.
+        """
+        view = self.snapshot()
+        view.shift_y = shift
+        columns = view.view_columns()
 
-        b = []
-        for x,_x in enumerate(self.inverted):
-            a = []
-            for y,_y in enumerate(_x):
-                select = _y[channel - off : channel + off].copy()
+        counts = zeros(self.inverted.shape[:2],dtype=int64)
+        add.at(counts,(expand_dims(arange(columns.shape[0]),1),columns),1)
 
-                y = pad(select,(off,off),'edge')
-                filtered = signal.convolve(y, win, mode='valid') / sum(win)
-                filtered = filtered[:-1]
+        return counts
 
-                f = filtered.argmax() - off
+    def shift_z(self,channel = 555,refine = None):
+        """
+        Align every pixel spectrum to the reflection at `channel`.
 
-                if f > -off and f < off:
-                    a += [roll(_y,-f)]
-                else:
-                    a += [_y]
+        The shifts are estimated from inverted and applied to inverted and,
+        when present, convoluted, which are loaded into memory. See Alignment.
+        """
+        self.preprocessing['align'] = {'channel':channel,'refine':refine}
 
-            b += [array(a)]
+        with stage('shift_z','Aligning spectra',channel=channel,refine=refine):
+            alignment = Alignment(channel,refine=refine)
+            shift = alignment.estimate(self.inverted[()])
 
-        self.inverted = array(b)
+            self.inverted = alignment.apply(self.inverted[()],shift)
+            if hasattr(self,'convoluted'):
+                self.convoluted = alignment.apply(self.convoluted[()],shift)
 
 class Preprocessing():
 
-    def convolve(data,off = 48):
+    def tiled(fce,data,out,tile = 8,workers = None,axis = 0):
+        """
+        Apply fce to tiles of `tile` slices along `axis` on a thread pool.
+
+        Every result is written in place into out. fce must treat the slices
+        along `axis` independently, e.g. the pixel spectra of map rows.
+
+        Parameters
+        ---------
+        tile: int
+            number of slices per tile, None processes the whole array at once.
+        workers: int
+            number of threads, None uses all cores and 1 runs serially.
+        """
+        if tile is None:
+            tile = max(data.shape[axis],1)
+
+        def run(start):
+            index = (slice(None),) * axis + (slice(start,start + tile),)
+            out[index] = fce(data[index])
+
+        starts = range(0,data.shape[axis],tile)
+
+        with pool(workers,ThreadPoolExecutor) as executor:
+            if executor is None:
+                for start in starts:
+                    run(start)
+            else:
+                list(executor.map(run,starts))
+
+        return out
+
+    def convolve(data,off = 48,workers = None,tile = 8,dtype = float64):
         """
         FIXME
 
         The gaussian convolution is only good for gaussian peaks i.e. low noise/signal ration
+
+        Map rows are smoothed in tiles of `tile` rows on `workers` threads,
+        in float64 and stored as `dtype`.
         """
 
-        def select(d,off):
-            c1 = []
-            for i in range(d.shape[0]):
-                c2 = []
-                for j in range(d.shape[1]):
-                    k = kurtosis(d[i,j])
-                    if k < 2:
-                        sigma = sqrt(d[i,j].std())
-                        _w = signal.windows.gaussian(off * 2 - 1 ,sigma)
-                    else:
-                        _w = signal.windows.exponential(off * 2 - 1 ,tau = 1)
-                    c2 += [_w]
-                c1 += [array(c2)]
+        def smooth(data):
+            def select(d,off):
+                """
+                Per pixel windows for the whole cube at once: gaussian with sigma = sqrt(std)
+                for spectra with kurtosis < 2, exponential with tau = 1 otherwise.
+                """
+                n = arange(off * 2 - 1) - (off - 1.0)
 
-            return array(c1)
+                k = stats.kurtosis(d,axis=2)
+                sigma = expand_dims(sqrt(d.std(axis=2)),2)
 
-        win = signal.windows.gaussian(off * 2 - 1 ,3) 
-        pad_data = pad(data,((0,0),(0,0),(off,off)),'edge')
+                with errstate(divide='ignore',invalid='ignore'):
+                    gaussian = exp(-n**2 / (2 * sigma * sigma))
+                exponential = exp(-abs(n))
 
-        f = fft.rfft(pad_data)
-        w = fft.rfft(win,pad_data.shape[-1])
-        x = fft.irfft(f * w)
+                return where(expand_dims(k < 2,2),gaussian,exponential)
 
-        x = x[:,:,off*2-1:-1]
-        x = x / sum(win)
+            win = signal.windows.gaussian(off * 2 - 1 ,3) 
+            pad_data = pad(data,((0,0),(0,0),(off,off)),'edge')
 
-        for i in range(2):
-            d = data - x
-            win = select(d,off)
-   
+            f = fft.rfft(pad_data)
             w = fft.rfft(win,pad_data.shape[-1])
             x = fft.irfft(f * w)
 
             x = x[:,:,off*2-1:-1]
-            sum_win = expand_dims(win.sum(axis=2),2)
-            x = x / sum_win
+            x = x / sum(win)
 
-        return x
+            for i in range(2):
+                d = data - x
+                win = select(d,off)
+   
+                w = fft.rfft(win,pad_data.shape[-1])
+                x = fft.irfft(f * w)
 
-    def snip(data,snip_m):
-        x = data.copy()
-        for p in range(1,snip_m)[::-1]:
-            a1 = x[p:-p]
-            a2 = (x[:(-2 * p)] + x[(2 * p):]) * 0.5
-            x[p:-p] = minimum(a2,a1)
-        return x
+                x = x[:,:,off*2-1:-1]
+                sum_win = expand_dims(win.sum(axis=2),2)
+                x = x / sum_win
+
+            return x
+
+        out = empty(data.shape,dtype=dtype)
+        return Preprocessing.tiled(smooth,data,out,tile,workers)
+
+    def snip(data,snip_m,workers = None,tile = 8,lls = False,dtype = float64):
+        """
+        SNIP background along the channel (last) axis.
+
+        Works on a single spectrum, a batch of spectra or a cube, the latter two
+        in tiles of `tile` rows on `workers` threads.
+
+        Parameters
+        ---------
+        snip_m: int
+            SNIP window, the clipping runs for p = snip_m - 1 ... 1.
+        lls: bool
+            clip the log-log-sqrt transformed spectra.
+        dtype: dtype
+            of the background, computed in float64 either way.
+        """
+        def snip(data):
+            x = asarray(data,dtype=float64)
+
+            if lls:
+                x = log(log(sqrt(x + 1) + 1) + 1)
+            else:
+                x = x.copy()
+
+            for p in range(1,snip_m)[::-1]:
+                a1 = x[...,p:-p]
+                a2 = (x[...,:(-2 * p)] + x[...,(2 * p):]) * 0.5
+                x[...,p:-p] = minimum(a2,a1)
+
+            if lls:
+                x = (exp(exp(x) - 1) - 1)**2 - 1
+
+            return x
+
+        if data.ndim < 2:
+            return snip(data).astype(dtype,copy=False)
+
+        out = empty(data.shape,dtype=dtype)
+        return Preprocessing.tiled(snip,data,out,tile,workers)
 
     def shift_y(data,n):
 
@@ -410,28 +1633,151 @@ class Preprocessing():
             return pad_right(data,n)
 
     def shift_z(data,off=24,channel=555):
-        
-        b = []
-        for i,x in enumerate(data):
-            a = []
-            for j,y in enumerate(x):
-                select = y[channel - off : channel + off]
-                f = select.argmax() - off
-
-                if f > -off/2 and f < off/2:
-                    a += [-f]
-                else:
-                    a += [0]
-            b += [asarray(a)]
+        """
+        Per pixel z-shift that moves the maximum of the window [channel - off,channel + off) to its center.
 
-        return asarray(b)
+        Shifts of off/2 channels or more are set to 0.
+        """
+        f = data[:,:,channel - off : channel + off].argmax(axis=2) - off
+
+        return where((f > -off/2) & (f < off/2),-f,0)
 
     def apply_shift_z(data,shift):
-        u = []
-        for _y,_x in zip(data,shift):
-            v = []
-            for y,x in zip(_y,_x):
-                v += [roll(y,x)]
-            u += [asarray(v)]
-        return asarray(u)
+        """
+        Roll every pixel spectrum by its shift.
+
+        Every map row is one gather along the channel axis written into a preallocated output.
+        """
+        if shift.dtype.kind == 'f':
+            return Preprocessing.interpolate_shift_z(data,shift)
+
+        out = empty(data.shape,dtype=data.dtype)
+        channels = arange(data.shape[2])
+
+        for i in range(data.shape[0]):
+            index = (channels - expand_dims(shift[i],1)) % data.shape[2]
+            out[i] = take_along_axis(data[i],index,axis=1)
+
+        return out
+
+    def interpolate_shift_z(data,shift):
+        """
+        Roll every pixel spectrum by a fractional shift with linear interpolation.
+
+        Counts up to 16 bits and float32 data give float32, wider data float64.
+        """
+        out = empty(data.shape,dtype=result_type(data.dtype,float32))
+        channels = arange(data.shape[2])
+
+        for i in range(data.shape[0]):
+            s = floor(shift[i])
+            t = expand_dims(shift[i] - s,1)
+
+            index = (channels - expand_dims(s.astype(int64),1)) % data.shape[2]
+            out[i] = (1 - t) * take_along_axis(data[i],index,axis=1) + t * take_along_axis(data[i],(index - 1) % data.shape[2],axis=1)
+
+        return out
+
+class Alignment():
+    """
+    Alignment of the pixel spectra to a reference reflection.
+
+    The window [channel - off,channel + off) is filtered with a gaussian for a
+    block of map rows at a time and the position of its maximum gives the shift
+    of every pixel. The maximum can be refined to sub-channel precision with a
+    parabola through its neighbours or with the centroid of the peak top.
+
+    Parameters
+    ---------
+    channel: int
+        channel of the reference reflection.
+    off: int
+        half width of the window.
+    sigma: float
+        std of the gaussian filter.
+    refine: str
+        None for integer shifts, 'parabolic' or 'centroid'.
+    rows: int
+        map rows filtered at once, bounds the memory.
+    """
+    def __init__(self,channel = 555,off = 24,sigma = sqrt(8.1),refine = None,rows = 16):
+        if refine not in (None,'parabolic','centroid'):
+            raise ValueError('unknown refinement: %s'%refine)
+
+        self.channel = channel
+        self.off = off
+        self.refine = refine
+        self.rows = rows
+
+        self.win = signal.windows.gaussian(off * 2,sigma)
+
+    def filtered(self,data):
+        """
+        Filtered window of a block of map rows.
+        """
+        off = self.off
+
+        select = data[:,:,self.channel - off : self.channel + off]
+        y = pad(select,((0,0),(0,0),(off,off)),'edge').astype(float64)
+
+        filtered = sliding_window_view(y,len(self.win),axis=2) @ self.win[::-1] / self.win.sum()
+
+        return filtered[:,:,:-1]
+
+    def peak(self,filtered):
+        """
+        Position of the maximum of the filtered windows.
+        """
+        f = filtered.argmax(axis=2)
+
+        if self.refine is None:
+            return f
+
+        n = filtered.shape[2]
+
+        def at(i):
+            return take_along_axis(filtered,expand_dims(clip(i,0,n - 1),2),axis=2)[:,:,0]
+
+        if self.refine == 'parabolic':
+            y0,y1,y2 = at(f - 1),at(f),at(f + 1)
+            denom = y0 - 2 * y1 + y2
+
+            with errstate(divide='ignore',invalid='ignore'):
+                delta = where((denom < 0) & (f > 0) & (f < n - 1),0.5 * (y0 - y2) / denom,0.0)
+
+        else:
+            k = arange(-2,3)
+            top = stack([at(f + i) for i in k],-1)
+            top = top - top.min(axis=2,keepdims=True)
+            inside = (expand_dims(f,2) + k >= 0) & (expand_dims(f,2) + k < n)
+            top = where(inside,top,0)
+
+            with errstate(divide='ignore',invalid='ignore'):
+                delta = where(top.sum(axis=2) > 0,(top * k).sum(axis=2) / top.sum(axis=2),0.0)
+
+        return f + delta
+
+    def estimate(self,data):
+        """
+        Per pixel shift that moves the filtered maximum to the window center.
+
+        Shifts of off channels or more are set to 0. The shifts are integers
+        unless a refinement is selected.
+        """
+        off = self.off
+        shift = empty(data.shape[:2],dtype=int64 if self.refine is None else float64)
+
+        # the even window puts filtered[i] half a channel before select[i]
+        bias = 0 if self.refine is None else 0.5
+
+        for start in range(0,data.shape[0],self.rows):
+            f = self.peak(self.filtered(data[start:start + self.rows])) - off - bias
+            shift[start:start + self.rows] = where((f > -off) & (f < off),-f,0)
+
+        return shift
+
+    def apply(self,data,shift):
+        return Preprocessing.apply_shift_z(data,shift)
 
+    def align(self,data):
+        return self.apply(data,self.estimate(data))